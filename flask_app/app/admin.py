@@ -0,0 +1,28 @@
+import os
+import secrets
+from functools import wraps
+
+from flask import jsonify, request
+
+# Operational endpoints (metrics, cache, pool and slow query reports) answer
+# only to "Authorization: Bearer <ADMIN_TOKEN>"; unset disables them.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+
+def authorized(header: str) -> bool:
+    scheme, _, sent = header.partition(" ")
+    return scheme.lower() == "bearer" and secrets.compare_digest(
+        sent.encode(), ADMIN_TOKEN.encode()
+    )
+
+
+def admin_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify(error="Not found"), 404
+        if not authorized(request.headers.get("Authorization", "")):
+            return jsonify(error="Unauthorized"), 401, {"WWW-Authenticate": "Bearer"}
+        return view(*args, **kwargs)
+
+    return wrapper
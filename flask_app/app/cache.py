@@ -0,0 +1,331 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlencode
+from urllib.request import Request, urlopen
+
+import bson
+from pydantic import BaseModel
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "auto")
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 512))
+CACHE_TTL = float(os.getenv("CACHE_TTL", 30))
+# How long after a write a secondary may still miss it; keep it at least
+# MONGODB_MAX_STALENESS_SECONDS. Reads from secondaries within that window
+# are served but not cached.
+CACHE_SETTLE_SECONDS = float(os.getenv("CACHE_SETTLE_SECONDS", 90))
+# Cache names declared with cache2 in wsgi.ini
+UWSGI_RESPONSES_CACHE = os.getenv("UWSGI_RESPONSES_CACHE", "responses")
+UWSGI_COUNTERS_CACHE = os.getenv("UWSGI_COUNTERS_CACHE", "counters")
+# nginx endpoint that bumps its micro-cache versions (nginx/cache.js)
+NGINX_CACHE_BUMP_URL = os.getenv("NGINX_CACHE_BUMP_URL")
+NGINX_CACHE_BUMP_TIMEOUT = float(os.getenv("NGINX_CACHE_BUMP_TIMEOUT", 0.5))
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES, ttl: float = CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._times = {}
+        self._epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self._incr("expirations")
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._incr("evictions")
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def _incr(self, counter: str) -> None:
+        self._counters[counter] = self._counters.get(counter, 0) + 1
+
+    def incr(self, counter: str) -> None:
+        with self._lock:
+            self._incr(counter)
+
+    def counter(self, counter: str) -> int:
+        return self._counters.get(counter, 0)
+
+    def get_time(self, key: str) -> Optional[float]:
+        return self._times.get(key)
+
+    def set_time(self, key: str, value: float) -> None:
+        self._times[key] = value
+
+    def epoch(self) -> str:
+        return self._epoch
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+            self._times.clear()
+            self._epoch = uuid.uuid4().hex[:8]
+
+    def stats(self) -> dict:
+        return {
+            "evictions": self.counter("evictions"),
+            "expirations": self.counter("expirations"),
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
+
+
+# Host-wide cache shared by every uWSGI worker through the cache framework.
+# Generations and hit/miss counters live in a separate cache without LRU
+# purging, so a busy responses cache can never evict a generation and bring
+# stale entries back to life.
+class UWSGIBackend:
+    name = "uwsgi"
+
+    def __init__(
+        self,
+        uwsgi,
+        ttl: float = CACHE_TTL,
+        responses: str = UWSGI_RESPONSES_CACHE,
+        counters: str = UWSGI_COUNTERS_CACHE,
+        max_entries: int = CACHE_MAX_ENTRIES,
+    ):
+        self.uwsgi = uwsgi
+        self.ttl = ttl
+        # Only reported: the size is fixed by cache2 in wsgi.ini
+        self.max_entries = max_entries
+        self.responses = responses
+        self.counters = counters
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.uwsgi.cache_get(key, self.responses)
+
+    def set(self, key: str, value: bytes) -> None:
+        self.uwsgi.cache_update(key, value, max(1, int(self.ttl)), self.responses)
+
+    def delete(self, key: str) -> None:
+        self.uwsgi.cache_del(key, self.responses)
+
+    def incr(self, counter: str) -> None:
+        self.uwsgi.cache_inc(counter, 1, 0, self.counters)
+
+    def counter(self, counter: str) -> int:
+        return self.uwsgi.cache_num(counter, self.counters) or 0
+
+    def get_time(self, key: str) -> Optional[float]:
+        value = self.uwsgi.cache_get(key, self.counters)
+        return None if value is None else float(value)
+
+    def set_time(self, key: str, value: float) -> None:
+        self.uwsgi.cache_update(key, f"{value:.3f}".encode(), 0, self.counters)
+
+    def epoch(self) -> str:
+        # cache_set never overwrites, so the first worker to get here picks
+        # the epoch and every other worker reads the same one.
+        epoch = self.uwsgi.cache_get("epoch", self.counters)
+        if epoch is None:
+            self.uwsgi.cache_set(
+                "epoch", uuid.uuid4().hex[:8].encode(), 0, self.counters
+            )
+            epoch = self.uwsgi.cache_get("epoch", self.counters)
+        return epoch.decode()
+
+    def clear(self) -> None:
+        self.uwsgi.cache_clear(self.responses)
+        self.uwsgi.cache_clear(self.counters)
+
+    def stats(self) -> dict:
+        return {
+            "evictions": None,
+            "expirations": None,
+            "entries": None,
+            "max_entries": self.max_entries,
+        }
+
+
+# The nginx micro-cache keys embed per-collection versions that only move
+# when the app reports a write, so a write is visible through nginx at once.
+class EdgeCache:
+    def __init__(
+        self,
+        url: Optional[str] = NGINX_CACHE_BUMP_URL,
+        timeout: float = NGINX_CACHE_BUMP_TIMEOUT,
+    ):
+        self.url = url
+        self.timeout = timeout
+
+    def bump(self, collection: str) -> None:
+        if not self.url:
+            return
+        request = Request(
+            f"{self.url}?{urlencode({'collection': collection})}", method="POST"
+        )
+        try:
+            urlopen(request, timeout=self.timeout).close()
+        except OSError as e:
+            logger.warning("nginx cache bump failed for %s: %s", collection, e)
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        backend,
+        edge: Optional[EdgeCache] = None,
+        settle_seconds: float = CACHE_SETTLE_SECONDS,
+    ):
+        self.backend = backend
+        self.edge = edge
+        self.settle_seconds = settle_seconds
+
+    def generation(self, collection: str) -> int:
+        return self.backend.counter(f"generation:{collection}")
+
+    def version(self, collection: str) -> str:
+        # The epoch changes whenever the counters are reset (restart, clear),
+        # so a version string is never reused for different data.
+        return f"{self.backend.epoch()}.{self.generation(collection)}"
+
+    def _bump(self, name: str) -> None:
+        self.backend.incr(f"generation:{name}")
+        self.backend.set_time(f"bumped:{name}", time.time())
+
+    def bump(self, collection: str) -> None:
+        # Keys embed the generation, so entries written before a change can
+        # never be read again and simply age out of the LRU.
+        self._bump(collection)
+        if self.edge is not None:
+            self.edge.bump(collection)
+
+    def bump_documents(self, collection: str) -> None:
+        self._bump(f"{collection}:documents")
+
+    def settled(self, *names: str) -> bool:
+        # Whether every secondary has had time to see the last bump of each
+        # name (a collection, or "<collection>:documents"). With no bump on
+        # record (restart, clear) the window starts now, since a write may
+        # have just happened elsewhere.
+        now = time.time()
+        for name in names:
+            bumped = self.backend.get_time(f"bumped:{name}")
+            if bumped is None:
+                bumped = now
+                self.backend.set_time(f"bumped:{name}", now)
+            if now - bumped < self.settle_seconds:
+                return False
+        return True
+
+    def key(
+        self, collection: str, query: BaseModel, related: Optional[str] = None
+    ) -> str:
+        version = self.version(collection)
+        if related:
+            # Expanded responses embed documents of the related collection,
+            # so a write to either one has to change the key.
+            version = f"{version}+{self.version(related)}"
+        params = json.dumps(query.dict(), sort_keys=True, default=str)
+        return f"{collection}:{version}:{params}"
+
+    def count_key(self, collection: str, filter_query: dict) -> str:
+        params = json.dumps(filter_query, sort_keys=True, default=str)
+        return f"count:{collection}:{self.version(collection)}:{params}"
+
+    def get_count(self, collection: str, filter_query: dict) -> Optional[int]:
+        value = self.backend.get(self.count_key(collection, filter_query))
+        return None if value is None else int(value)
+
+    def set_count(self, collection: str, filter_query: dict, total: int) -> None:
+        self.backend.set(self.count_key(collection, filter_query), str(total).encode())
+
+    def documents_version(self, collection: str) -> str:
+        return self.version(f"{collection}:documents")
+
+    def document_key(
+        self, collection: str, doc_id, version: Optional[str] = None
+    ) -> str:
+        # Every write bumps a generation shared by all documents of the
+        # collection. Readers take the version before querying, as list pages
+        # do, so a document read before a concurrent write is stored under
+        # the old version and never served after it.
+        version = version or self.documents_version(collection)
+        return f"{collection}:documents:{version}:{doc_id}"
+
+    def get_document(self, collection: str, doc_id) -> Optional[dict]:
+        value = self.get(self.document_key(collection, doc_id))
+        return None if value is None else bson.decode(value)
+
+    def set_document(
+        self, collection: str, doc: dict, version: Optional[str] = None
+    ) -> None:
+        self.backend.set(
+            self.document_key(collection, doc["_id"], version), bson.encode(doc)
+        )
+
+    def get(self, key: str) -> Optional[bytes]:
+        value = self.backend.get(key)
+        self.backend.incr("misses" if value is None else "hits")
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        self.backend.set(key, value)
+
+    # Compressed copies of a cached body, so hot pages are compressed once
+    def get_encoded(self, key: str, encoding: str) -> Optional[bytes]:
+        return self.backend.get(f"{key}|{encoding}")
+
+    def set_encoded(self, key: str, encoding: str, value: bytes) -> None:
+        self.backend.set(f"{key}|{encoding}", value)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend.name,
+            "hits": self.backend.counter("hits"),
+            "misses": self.backend.counter("misses"),
+            "ttl": self.backend.ttl,
+            **self.backend.stats(),
+        }
+
+
+def build_backend(name: str = CACHE_BACKEND):
+    if name in ("auto", "uwsgi"):
+        try:
+            import uwsgi
+        except ImportError:
+            if name == "uwsgi":
+                raise
+        else:
+            return UWSGIBackend(uwsgi)
+    return MemoryBackend()
+
+
+response_cache = ResponseCache(build_backend(), EdgeCache())
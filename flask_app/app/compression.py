@@ -0,0 +1,34 @@
+import gzip
+import os
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", 1024))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", 6))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", 5))
+COMPRESSIBLE_MIMETYPES = ("application/json",)
+
+# In order of preference when the client accepts several with the same q
+ENCODINGS = ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def negotiate(accept_encodings, size: int) -> Optional[str]:
+    if size < COMPRESSION_MIN_SIZE:
+        return None
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+    # mtime=0 keeps the output identical for identical input
+    return gzip.compress(data, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    # A strong ETag names one representation, so each encoding gets its own
+    return f"{etag}-{encoding}"
@@ -1,5 +1,34 @@
+import logging
 import os
-from pymongo import MongoClient
+import random
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+import pymongo
+from bson import json_util
+from pymongo import ASCENDING, IndexModel, MongoClient, monitoring
+from pymongo.errors import PyMongoError
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import (
+    Primary,
+    read_pref_mode_from_name,
+    make_read_preference,
+)
+from pymongo.write_concern import WriteConcern
+
+try:
+    import uwsgidecorators
+except ImportError:
+    uwsgidecorators = None
+
+import timing
+from metrics import MONGO_FAILURES, MONGO_LATENCY
+from models import FILM_SORT_FIELDS, PLANET_SORT_FIELDS
+from search import FILM_SEARCH_FIELDS, PLANET_SEARCH_FIELDS, SEARCH_FIELD
 
 # Environment variables
 MONGODB_HOST = os.getenv("MONGODB_HOST", "mongodb")
@@ -7,32 +36,487 @@ MONGODB_PORT = int(os.getenv("MONGODB_PORT", 27017))
 MONGODB_USER = os.getenv("MONGODB_USER", "root")
 MONGODB_PASS = os.getenv("MONGODB_PASS", "pass")
 MONGODB_DB_NAME = os.getenv("MONGODB_DB_NAME", "starwars_db")
+MONGODB_MAX_POOL_SIZE = int(os.getenv("MONGODB_MAX_POOL_SIZE", 100))
+MONGODB_MIN_POOL_SIZE = int(os.getenv("MONGODB_MIN_POOL_SIZE", 0))
+MONGODB_MAX_IDLE_TIME_MS = os.getenv("MONGODB_MAX_IDLE_TIME_MS")
+MONGODB_WAIT_QUEUE_TIMEOUT_MS = os.getenv("MONGODB_WAIT_QUEUE_TIMEOUT_MS")
+# Comma separated, e.g. "zstd,snappy,zlib" (zstd and snappy need extra packages)
+MONGODB_COMPRESSORS = os.getenv("MONGODB_COMPRESSORS")
+MONGODB_WARM_UP = os.getenv("MONGODB_WARM_UP", "true") == "true"
+MONGODB_WARM_UP_TIMEOUT = float(os.getenv("MONGODB_WARM_UP_TIMEOUT", 5))
+# Lists go to secondaries; writes and read-your-writes reads go to the primary
+MONGODB_READ_PREFERENCE = os.getenv("MONGODB_READ_PREFERENCE", "secondaryPreferred")
+MONGODB_MAX_STALENESS_SECONDS = int(os.getenv("MONGODB_MAX_STALENESS_SECONDS", 90))
+MONGODB_READ_CONCERN = os.getenv("MONGODB_READ_CONCERN", "local")
+MONGODB_WRITE_CONCERN = os.getenv("MONGODB_WRITE_CONCERN", "majority")
+MONGODB_WRITE_CONCERN_JOURNAL = os.getenv("MONGODB_WRITE_CONCERN_JOURNAL")
+MONGODB_WRITE_CONCERN_TIMEOUT_MS = os.getenv("MONGODB_WRITE_CONCERN_TIMEOUT_MS")
+# How long a client that just wrote keeps reading from the primary (0 = off)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", 5))
+# Signs the read_primary_until cookie so clients cannot pin themselves. When
+# unset it is generated at app load, which every uWSGI worker forked from the
+# master shares; set it when several hosts serve the API.
+READ_PRIMARY_SECRET = os.getenv("READ_PRIMARY_SECRET") or secrets.token_hex(16)
+# Finds and aggregates slower than this are recorded (negative = off)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 100))
+# Fraction of the slow queries whose plan is also explained
+SLOW_QUERY_EXPLAIN_RATE = float(os.getenv("SLOW_QUERY_EXPLAIN_RATE", 0.1))
+SLOW_QUERY_TTL_SECONDS = int(os.getenv("SLOW_QUERY_TTL_SECONDS", 7 * 24 * 3600))
+SLOW_QUERY_REPORT_LIMIT = 1000
+SLOW_QUERIES = "slow_queries"
+
+logger = logging.getLogger(__name__)
+
+# Set per request when the caller wrote recently and must see its own writes
+read_primary = ContextVar("read_primary", default=False)
+
+SORT_FIELDS = {
+    "films": FILM_SORT_FIELDS,
+    "planets": PLANET_SORT_FIELDS,
+}
+FILTER_FIELDS = {
+    "films": tuple(f"{SEARCH_FIELD}.{field}" for field in FILM_SEARCH_FIELDS),
+    "planets": tuple(f"{SEARCH_FIELD}.{field}" for field in PLANET_SEARCH_FIELDS),
+}
+
+
+def sort_index(field: str) -> list:
+    return [(field, ASCENDING), ("_id", ASCENDING)]
+
+
+# Every allowed sort key gets a compound index with _id, which also serves the
+# keyset pagination tie-break; the same index is walked backwards for "-field".
+INDEXES = {
+    collection: [IndexModel(sort_index(field)) for field in SORT_FIELDS[collection]]
+    + [IndexModel([(field, ASCENDING)]) for field in FILTER_FIELDS[collection]]
+    for collection in SORT_FIELDS
+}
+# Slow query entries expire instead of piling up
+INDEXES[SLOW_QUERIES] = [
+    IndexModel([("at", ASCENDING)], expireAfterSeconds=SLOW_QUERY_TTL_SECONDS)
+]
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters = dict.fromkeys(
+                (
+                    "open",
+                    "checked_out",
+                    "waiting",
+                    "created",
+                    "closed",
+                    "checkout_failed",
+                    "pool_cleared",
+                ),
+                0,
+            )
+
+    def _add(self, **deltas) -> None:
+        with self._lock:
+            for name, delta in deltas.items():
+                self.counters[name] += delta
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(pool_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(created=1, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(closed=1, open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, checkout_failed=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._add(checked_out=-1)
+
+
+pool_stats = PoolStats()
+
+
+class CommandMetrics(monitoring.CommandListener):
+    # Only the started event names the collection, so it is remembered until
+    # the matching succeeded/failed event arrives.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._collections = {}
+
+    @staticmethod
+    def _key(event) -> tuple:
+        return event.connection_id, event.request_id, event.operation_id
+
+    def _pop(self, event) -> str:
+        with self._lock:
+            return self._collections.pop(self._key(event), "")
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            target = event.command.get("collection")
+        with self._lock:
+            self._collections[self._key(event)] = (
+                target if isinstance(target, str) else ""
+            )
+
+    def succeeded(self, event):
+        MONGO_LATENCY.labels(self._pop(event), event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+        timing.add("mongo", event.duration_micros / 1e6)
+
+    def failed(self, event):
+        collection = self._pop(event)
+        MONGO_LATENCY.labels(collection, event.command_name).observe(
+            event.duration_micros / 1e6
+        )
+        timing.add("mongo", event.duration_micros / 1e6)
+        MONGO_FAILURES.labels(collection, event.command_name).inc()
+
+
+command_metrics = CommandMetrics()
+
+
+def query_fields(filter_query: dict) -> List[str]:
+    # Field names a filter touches, through $or/$and, e.g. the keyset clause
+    fields = set()
+    for key, value in filter_query.items():
+        if not key.startswith("$"):
+            fields.add(key)
+        elif isinstance(value, list):
+            for clause in value:
+                if isinstance(clause, dict):
+                    fields.update(query_fields(clause))
+    return sorted(fields)
+
+
+def query_shape(value):
+    # The filter with every value the client sent replaced, keeping field
+    # names and operators: what was searched for stays out of logs and reports
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [query_shape(item) for item in value]
+    return "?"
+
+
+def sort_spec(sort: Optional[list]) -> str:
+    return ",".join(f"{field}:{d}" for field, d in sort or [])
+
+
+def plan_nodes(plan: dict):
+    yield plan
+    for key in ("inputStage", "queryPlan"):
+        if key in plan:
+            yield from plan_nodes(plan[key])
+    for child in plan.get("inputStages", []):
+        yield from plan_nodes(child)
+
+
+def plan_summary(explain: dict) -> dict:
+    # find explains at the top level; aggregate nests the query in $cursor
+    # unless the whole pipeline was pushed down into the query.
+    planner = explain.get("queryPlanner")
+    stages = explain.get("stages", [])
+    for stage in stages:
+        if "$cursor" in stage:
+            planner = stage["$cursor"].get("queryPlanner")
+    nodes = list(plan_nodes((planner or {}).get("winningPlan", {})))
+    names = [node["stage"] for node in nodes if "stage" in node]
+    return {
+        "stages": names,
+        "indexes": [node["indexName"] for node in nodes if "indexName" in node],
+        "collscan": "COLLSCAN" in names,
+        # A $sort left in the pipeline also sorts in memory
+        "in_memory_sort": "SORT" in names or any("$sort" in s for s in stages),
+    }
+
+
+class SlowQueryLog:
+    # Entries go to a collection rather than process memory, so every uWSGI
+    # worker reports to the same place and the CLI can read them.
+    def __init__(
+        self,
+        threshold_ms: float = SLOW_QUERY_MS,
+        explain_rate: float = SLOW_QUERY_EXPLAIN_RATE,
+    ):
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+
+    @contextmanager
+    def track(
+        self,
+        collection,
+        operation: str,
+        filter_query: dict,
+        sort: Optional[list] = None,
+        skip: int = 0,
+        limit: int = 0,
+        explain: Optional[Callable[[], dict]] = None,
+    ):
+        start = time.perf_counter()
+        yield
+        duration_ms = (time.perf_counter() - start) * 1000
+        if 0 <= self.threshold_ms <= duration_ms:
+            self.record(
+                collection,
+                operation,
+                filter_query,
+                sort,
+                skip,
+                limit,
+                duration_ms,
+                explain,
+            )
+
+    def record(
+        self,
+        collection,
+        operation: str,
+        filter_query: dict,
+        sort: Optional[list],
+        skip: int,
+        limit: int,
+        duration_ms: float,
+        explain: Optional[Callable[[], dict]] = None,
+    ) -> None:
+        entry = {
+            "at": datetime.now(timezone.utc),
+            "collection": collection.name,
+            "operation": operation,
+            "fields": query_fields(filter_query),
+            "filter": json_util.dumps(query_shape(filter_query)),
+            "sort": sort_spec(sort),
+            "skip": skip,
+            "limit": limit,
+            "duration_ms": round(duration_ms, 3),
+        }
+        logger.warning(
+            "Slow %s on %s (%.1f ms): filter=%s sort=%s skip=%s limit=%s",
+            operation,
+            collection.name,
+            duration_ms,
+            entry["filter"],
+            entry["sort"],
+            skip,
+            limit,
+        )
+        if explain is not None and random.random() < self.explain_rate:
+            try:
+                entry["plan"] = plan_summary(explain())
+            except Exception as e:
+                # Diagnostics must never fail the request that was slow
+                logger.warning("Explain of slow %s failed: %s", operation, e)
+        try:
+            MongoDBConnection.get_db().get_collection(
+                SLOW_QUERIES, write_concern=WriteConcern(w=0)
+            ).insert_one(entry)
+        except PyMongoError as e:
+            logger.warning("Slow query not recorded: %s", e)
+
+    def report(self, limit: int = SLOW_QUERY_REPORT_LIMIT) -> dict:
+        # Latest entries grouped by query shape: collection, operation,
+        # filtered fields and sort, i.e. one FilmFilter/PlanetsFilter combination.
+        entries = (
+            MongoDBConnection.get_db()[SLOW_QUERIES]
+            .find({}, {"_id": 0})
+            .sort("at", -1)
+            .limit(limit)
+        )
+        shapes = {}
+        for entry in entries:
+            key = (
+                entry["collection"],
+                entry["operation"],
+                tuple(entry["fields"]),
+                entry["sort"],
+            )
+            shape = shapes.setdefault(
+                key,
+                {
+                    "collection": entry["collection"],
+                    "operation": entry["operation"],
+                    "fields": entry["fields"],
+                    "sort": entry["sort"],
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "explained": 0,
+                    "collscan": 0,
+                    "in_memory_sort": 0,
+                    "example": entry["filter"],
+                    "plan": None,
+                },
+            )
+            shape["count"] += 1
+            shape["total_ms"] += entry["duration_ms"]
+            shape["max_ms"] = max(shape["max_ms"], entry["duration_ms"])
+            plan = entry.get("plan")
+            if plan:
+                shape["explained"] += 1
+                shape["collscan"] += plan["collscan"]
+                shape["in_memory_sort"] += plan["in_memory_sort"]
+                shape["plan"] = shape["plan"] or plan
+        for shape in shapes.values():
+            shape["total_ms"] = round(shape["total_ms"], 3)
+            shape["avg_ms"] = round(shape["total_ms"] / shape["count"], 3)
+        return {
+            "threshold_ms": self.threshold_ms,
+            "explain_rate": self.explain_rate,
+            "shapes": sorted(
+                shapes.values(), key=lambda shape: shape["total_ms"], reverse=True
+            ),
+        }
+
+
+slow_queries = SlowQueryLog()
+
+
+def client_options() -> dict:
+    options = {
+        "host": MONGODB_HOST,
+        "port": MONGODB_PORT,
+        "username": MONGODB_USER,
+        "password": MONGODB_PASS,
+        "authSource": "admin",
+        "maxPoolSize": MONGODB_MAX_POOL_SIZE,
+        "minPoolSize": MONGODB_MIN_POOL_SIZE,
+        "event_listeners": [pool_stats, command_metrics],
+    }
+    if MONGODB_MAX_IDLE_TIME_MS:
+        options["maxIdleTimeMS"] = int(MONGODB_MAX_IDLE_TIME_MS)
+    if MONGODB_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = int(MONGODB_WAIT_QUEUE_TIMEOUT_MS)
+    if MONGODB_COMPRESSORS:
+        options["compressors"] = MONGODB_COMPRESSORS
+    return options
+
+
+def reads_from_primary() -> bool:
+    return read_primary.get() or MONGODB_READ_PREFERENCE == "primary"
+
+
+def read_preference():
+    if reads_from_primary():
+        return Primary()
+    max_staleness = MONGODB_MAX_STALENESS_SECONDS or -1
+    return make_read_preference(
+        read_pref_mode_from_name(MONGODB_READ_PREFERENCE), None, max_staleness
+    )
+
+
+def write_concern() -> WriteConcern:
+    w = MONGODB_WRITE_CONCERN
+    return WriteConcern(
+        w=int(w) if w.isdigit() else w,
+        j=MONGODB_WRITE_CONCERN_JOURNAL == "true"
+        if MONGODB_WRITE_CONCERN_JOURNAL
+        else None,
+        wtimeout=int(MONGODB_WRITE_CONCERN_TIMEOUT_MS)
+        if MONGODB_WRITE_CONCERN_TIMEOUT_MS
+        else None,
+    )
 
 
 # MongoDB connection setup
 class MongoDBConnection:
     client = None
+    # pid of the process that created client; a MongoClient must never be
+    # shared across fork, so a worker that inherits one builds its own.
+    pid = None
 
     @classmethod
     def get_client(cls):
-        if cls.client is None:
-            cls.client = MongoClient(
-                host=MONGODB_HOST,
-                port=MONGODB_PORT,
-                username=MONGODB_USER,
-                password=MONGODB_PASS,
-                authSource="admin",
-            )
+        if cls.client is None or (cls.pid is not None and cls.pid != os.getpid()):
+            cls.client = MongoClient(**client_options())
+            cls.pid = os.getpid()
         return cls.client
 
+    @classmethod
+    def reset(cls) -> None:
+        # The inherited client's sockets are shared with the parent process,
+        # so it is dropped rather than closed.
+        cls.client = None
+        cls.pid = None
+
+    @classmethod
+    def warm_up(cls) -> None:
+        # Selecting a server opens the first connection; pymongo's pool
+        # maintenance then fills the pool up to minPoolSize in the background.
+        try:
+            with pymongo.timeout(MONGODB_WARM_UP_TIMEOUT):
+                cls.get_client().admin.command("ping")
+        except PyMongoError as e:
+            logger.warning("MongoDB warm up failed: %s", e)
+
+    @classmethod
+    def on_fork(cls) -> None:
+        cls.reset()
+        pool_stats.reset()
+        if MONGODB_WARM_UP:
+            cls.warm_up()
+
     @classmethod
     def get_db(cls):
         return cls.get_client()[MONGODB_DB_NAME]
 
     @classmethod
-    def films(cls):
-        return cls.get_db().films
+    def collection(cls, name: str, operation: str = "write"):
+        if operation == "read":
+            return cls.get_db().get_collection(
+                name,
+                read_preference=read_preference(),
+                read_concern=ReadConcern(MONGODB_READ_CONCERN),
+            )
+        return cls.get_db().get_collection(
+            name, read_preference=Primary(), write_concern=write_concern()
+        )
+
+    @classmethod
+    def films(cls, operation: str = "write"):
+        return cls.collection("films", operation)
+
+    @classmethod
+    def planets(cls, operation: str = "write"):
+        return cls.collection("planets", operation)
 
     @classmethod
-    def planets(cls):
-        return cls.get_db().planets
+    def ensure_indexes(cls) -> dict:
+        # create_indexes is a no-op for indexes that already exist
+        db = cls.get_db()
+        return {
+            collection: db[collection].create_indexes(indexes)
+            for collection, indexes in INDEXES.items()
+        }
+
+
+if uwsgidecorators is not None:
+    uwsgidecorators.postfork(MongoDBConnection.on_fork)
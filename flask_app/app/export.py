@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+from typing import Callable, Iterable, Iterator, List
+
+# Rows are buffered into chunks of roughly this size before being handed to
+# the WSGI server, so memory stays flat without a write per document.
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+
+def ndjson_chunks(docs: Iterable[dict], dumps: Callable) -> Iterator[str]:
+    buffer = []
+    size = 0
+    for doc in docs:
+        line = dumps(doc) + "\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def csv_value(value, dumps: Callable):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, ensure_ascii=False)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.loads(dumps(value))
+
+
+def csv_chunks(
+    docs: Iterable[dict], columns: List[str], dumps: Callable
+) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for doc in docs:
+        writer.writerow([csv_value(doc.get(column), dumps) for column in columns])
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
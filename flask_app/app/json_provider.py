@@ -0,0 +1,93 @@
+import os
+import re
+from datetime import datetime
+
+from bson import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+import timing
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSON_PROVIDER = os.getenv("JSON_PROVIDER", "auto")
+
+# Everything the stdlib escapes with ensure_ascii, apart from the control
+# characters orjson already escapes the same way.
+_NON_ASCII = re.compile(r"[^\x00-\x7e]")
+
+
+def _escape(match) -> str:
+    code = ord(match.group())
+    if code > 0xFFFF:
+        code -= 0x10000
+        return "\\u%04x\\u%04x" % (0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF))
+    return "\\u%04x" % code
+
+
+class MongoJsonProvider(DefaultJSONProvider):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.strftime("%Y-%m-%d %H:%M:%S")
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        return super().default(obj)
+
+    def response(self, *args, **kwargs):
+        with timing.measure("serialization"):
+            return super().response(*args, **kwargs)
+
+
+class OrjsonProvider(MongoJsonProvider):
+    # Same output as MongoJsonProvider for compact and indented responses,
+    # except for floats: exponents are written the shortest way (1e16, 1e-7
+    # rather than 1e+16, 1e-07) and NaN/Infinity become null instead of the
+    # stdlib's non-JSON NaN/Infinity. Dates and dataclasses are passed through
+    # to default() so they keep their current format; anything orjson rejects
+    # (integers beyond 64 bits, non-string keys, lone surrogates) falls back to
+    # the stdlib.
+    def __init__(self, app):
+        super().__init__(app)
+        self.option = (
+            orjson.OPT_SORT_KEYS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+            | orjson.OPT_PASSTHROUGH_DATACLASS
+        )
+
+    def dumps_bytes(self, obj, indent: bool = False) -> bytes:
+        option = (self.option | orjson.OPT_INDENT_2) if indent else self.option
+        if not self.sort_keys:
+            option &= ~orjson.OPT_SORT_KEYS
+        try:
+            data = orjson.dumps(obj, default=self.default, option=option)
+        except orjson.JSONEncodeError:
+            kwargs = {"indent": 2} if indent else {"separators": (",", ":")}
+            return super().dumps(obj, **kwargs).encode()
+        if self.ensure_ascii and not data.isascii():
+            data = _NON_ASCII.sub(_escape, data.decode()).encode()
+        return data
+
+    def dumps(self, obj, **kwargs) -> str:
+        if kwargs == {"separators": (",", ":")}:
+            return self.dumps_bytes(obj).decode()
+        if kwargs == {"indent": 2}:
+            return self.dumps_bytes(obj, indent=True).decode()
+        return super().dumps(obj, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        with timing.measure("serialization"):
+            return self._app.response_class(
+                self.dumps_bytes(obj, indent) + b"\n", mimetype=self.mimetype
+            )
+
+
+def build_json_provider(app, name: str = JSON_PROVIDER):
+    if name == "orjson" or (name == "auto" and orjson is not None):
+        if orjson is None:
+            raise ImportError("JSON_PROVIDER=orjson but orjson is not installed")
+        return OrjsonProvider(app)
+    return MongoJsonProvider(app)
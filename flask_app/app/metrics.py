@@ -0,0 +1,75 @@
+import atexit
+import os
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# uWSGI runs several workers; with PROMETHEUS_MULTIPROC_DIR set each one
+# writes its samples there and /metrics aggregates the whole directory. The
+# directory must be emptied before the workers start.
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request",
+    ["method", "route"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests handled, by response status",
+    ["method", "route", "status"],
+)
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "Requests being handled",
+    ["method", "route"],
+    multiprocess_mode="livesum",
+)
+MONGO_LATENCY = Histogram(
+    "mongodb_command_duration_seconds",
+    "Time spent on a MongoDB command, as reported by the driver",
+    ["collection", "command"],
+    buckets=LATENCY_BUCKETS,
+)
+MONGO_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "MongoDB commands that failed",
+    ["collection", "command"],
+)
+
+
+def render() -> bytes:
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+if PROMETHEUS_MULTIPROC_DIR:
+    # Drops this worker's live gauges (in-flight requests) when it exits
+    atexit.register(lambda: multiprocess.mark_process_dead(os.getpid()))
@@ -1,28 +1,206 @@
 from datetime import datetime
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from pydantic import BaseModel, Field, conint, root_validator, validator
+from typing import List, Literal, Optional
+
+FILM_SORT_FIELDS = ("episode_id", "title", "director", "release_date", "created")
+PLANET_SORT_FIELDS = (
+    "name",
+    "rotation_period",
+    "orbital_period",
+    "diameter",
+    "population",
+    "last_updated",
+)
+
+FILM_FIELDS = (
+    "_id",
+    "title",
+    "episode_id",
+    "director",
+    "producer",
+    "release_date",
+    "planets",
+    "created",
+    "last_updated",
+)
+PLANET_FIELDS = (
+    "_id",
+    "name",
+    "rotation_period",
+    "orbital_period",
+    "diameter",
+    "climate",
+    "gravity",
+    "terrain",
+    "surface_water",
+    "population",
+    "residents",
+    "films",
+    "last_updated",
+)
 
 
 def now_str() -> str:
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+def check_order_by(order_by: str, allowed: tuple) -> str:
+    if order_by.lstrip("-") not in allowed:
+        raise ValueError(f"order_by must be one of: {', '.join(allowed)}")
+    return order_by
+
+
+def split_fields(value):
+    if isinstance(value, str):
+        return [field.strip() for field in value.split(",") if field.strip()]
+    return value
+
+
+def check_fields(fields: Optional[List[str]], allowed: tuple):
+    unknown = [field for field in fields or [] if field not in allowed]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return fields
+
+
+def check_fieldset(values: dict) -> dict:
+    if values.get("fields") and values.get("exclude"):
+        raise ValueError("fields and exclude cannot be combined")
+    return values
+
+
+def check_ids(values: dict) -> dict:
+    if values.get("ids") and (values.get("fields") or values.get("exclude")):
+        raise ValueError("ids cannot be combined with fields or exclude")
+    return values
+
+
+def check_expand(values: dict) -> dict:
+    # Related documents are joined on this field, so it has to be returned
+    expand = values.get("expand")
+    if expand and expand in (values.get("exclude") or []):
+        raise ValueError(f"expand={expand} cannot be combined with exclude={expand}")
+    if expand and values.get("fields") and expand not in values["fields"]:
+        values["fields"] = [*values["fields"], expand]
+    return values
+
+
 class FilmFilter(BaseModel):
-    page: Optional[int] = 1
-    page_size: Optional[int] = 10
+    page: conint(ge=1) = 1
+    page_size: conint(ge=1) = 10
     title: Optional[str] = None
     director: Optional[str] = None
     order_by: Optional[str] = "episode_id"
     planet: Optional[str]
+    cursor: Optional[str] = None
+    fields: Optional[List[str]] = None
+    exclude: Optional[List[str]] = None
+    include_total: bool = True
+    ids: Optional[List[str]] = None
+    expand: Optional[Literal["planets"]] = None
+
+    @validator("order_by")
+    def order_by_allowed(cls, value):
+        return check_order_by(value, FILM_SORT_FIELDS)
+
+    @validator("fields", "exclude", "ids", pre=True)
+    def split_fields(cls, value):
+        return split_fields(value)
+
+    @validator("fields", "exclude")
+    def fields_allowed(cls, value):
+        return check_fields(value, FILM_FIELDS)
+
+    @root_validator(skip_on_failure=True)
+    def fieldset(cls, values):
+        return check_fieldset(values)
+
+    @root_validator(skip_on_failure=True)
+    def expand_field(cls, values):
+        return check_expand(values)
+
+    @root_validator(skip_on_failure=True)
+    def ids_alone(cls, values):
+        return check_ids(values)
 
 
 class PlanetsFilter(BaseModel):
-    page: Optional[int] = 1
-    page_size: Optional[int] = 10
+    page: conint(ge=1) = 1
+    page_size: conint(ge=1) = 10
     film: Optional[str] = None
+    order_by: Optional[str] = "name"
+    name: Optional[str] = None
+    resident: Optional[str] = None
+    cursor: Optional[str] = None
+    fields: Optional[List[str]] = None
+    exclude: Optional[List[str]] = None
+    include_total: bool = True
+    ids: Optional[List[str]] = None
+    expand: Optional[Literal["films"]] = None
+
+    @validator("order_by")
+    def order_by_allowed(cls, value):
+        return check_order_by(value, PLANET_SORT_FIELDS)
+
+    @validator("fields", "exclude", "ids", pre=True)
+    def split_fields(cls, value):
+        return split_fields(value)
+
+    @validator("fields", "exclude")
+    def fields_allowed(cls, value):
+        return check_fields(value, PLANET_FIELDS)
+
+    @root_validator(skip_on_failure=True)
+    def fieldset(cls, values):
+        return check_fieldset(values)
+
+    @root_validator(skip_on_failure=True)
+    def expand_field(cls, values):
+        return check_expand(values)
+
+    @root_validator(skip_on_failure=True)
+    def ids_alone(cls, values):
+        return check_ids(values)
+
+
+class BulkOptions(BaseModel):
+    upsert: bool = False
+
+
+class BulkError(BaseModel):
+    index: int
+    error: str
+
+
+class BulkResult(BaseModel):
+    inserted: int
+    upserted: int
+    modified: int
+    errors: List[BulkError]
+
+
+class FilmExportFilter(BaseModel):
+    format: Literal["ndjson", "csv"] = "ndjson"
+    title: Optional[str] = None
+    director: Optional[str] = None
+    planet: Optional[str] = None
     order_by: Optional[str] = "episode_id"
+
+    @validator("order_by")
+    def order_by_allowed(cls, value):
+        return check_order_by(value, FILM_SORT_FIELDS)
+
+
+class PlanetsExportFilter(BaseModel):
+    format: Literal["ndjson", "csv"] = "ndjson"
     name: Optional[str] = None
+    film: Optional[str] = None
     resident: Optional[str] = None
+    order_by: Optional[str] = "name"
+
+    @validator("order_by")
+    def order_by_allowed(cls, value):
+        return check_order_by(value, PLANET_SORT_FIELDS)
 
 
 class Message(BaseModel):
@@ -33,6 +211,58 @@ class Error(BaseModel):
     error: str
 
 
+class CacheStats(BaseModel):
+    backend: str
+    hits: int
+    misses: int
+    evictions: Optional[int]
+    expirations: Optional[int]
+    entries: Optional[int]
+    max_entries: Optional[int]
+    ttl: float
+
+
+class PoolStats(BaseModel):
+    open: int
+    checked_out: int
+    waiting: int
+    created: int
+    closed: int
+    checkout_failed: int
+    pool_cleared: int
+    max_pool_size: int
+    min_pool_size: int
+
+
+class QueryPlan(BaseModel):
+    stages: List[str]
+    indexes: List[str]
+    collscan: bool
+    in_memory_sort: bool
+
+
+class SlowQueryShape(BaseModel):
+    collection: str
+    operation: str
+    fields: List[str]
+    sort: str
+    count: int
+    total_ms: float
+    max_ms: float
+    avg_ms: float
+    explained: int
+    collscan: int
+    in_memory_sort: int
+    example: str
+    plan: Optional[QueryPlan]
+
+
+class SlowQueryReport(BaseModel):
+    threshold_ms: float
+    explain_rate: float
+    shapes: List[SlowQueryShape]
+
+
 class Film(BaseModel):
     title: str
     episode_id: int
@@ -41,11 +271,32 @@ class Film(BaseModel):
     release_date: str
     planets: List[str]
 
+
 class FilmCreated(Film):
     created: str = Field(default_factory=now_str)
 
+
+# Shape of a film returned with a sparse fieldset (fields= / exclude=)
+class PartialFilm(BaseModel):
+    title: Optional[str]
+    episode_id: Optional[int]
+    director: Optional[str]
+    producer: Optional[List[str]]
+    release_date: Optional[str]
+    planets: Optional[List[str]]
+
+
 class FilmsResponse(BaseModel):
     films: List[Film]
+    planets: Optional[List["Planet"]] = None
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    page_count: Optional[int] = None
+    has_next: bool = False
+
+
+class PartialFilmsResponse(FilmsResponse):
+    films: List[PartialFilm]
 
 
 class Planet(BaseModel):
@@ -66,5 +317,25 @@ class Planet(BaseModel):
 class PlanetCreated(BaseModel):
     created: str = Field(default_factory=now_str)
 
+
+class PartialPlanet(Planet):
+    name: Optional[str]
+    films: Optional[List[str]]
+    last_updated: Optional[str]
+
+
 class PlanetsResponse(BaseModel):
     planets: List[Planet]
+    films: Optional[List[Film]] = None
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    page_count: Optional[int] = None
+    has_next: bool = False
+
+
+class PartialPlanetsResponse(PlanetsResponse):
+    planets: List[PartialPlanet]
+
+
+FilmsResponse.update_forward_refs(Planet=Planet)
+PartialFilmsResponse.update_forward_refs(Planet=Planet)
@@ -0,0 +1,143 @@
+import cProfile
+import io
+import itertools
+import os
+import pstats
+import re
+import secrets
+import threading
+import time
+from urllib.parse import parse_qs
+
+from werkzeug.exceptions import HTTPException
+
+# Requests sending this token in X-Profile run under cProfile; unset disables
+# on-demand profiling. Only a header: a query string ends up in access logs.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+# Profile 1 in N requests and aggregate them per route (0 = off)
+PROFILE_SAMPLE_EVERY = int(os.getenv("PROFILE_SAMPLE_EVERY", 0))
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", 40))
+# Streamed responses, which a profile would have to buffer whole; never sampled
+STREAMED_RULES = ("/films/export", "/planets/export")
+
+
+def route_slug(method: str, rule: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", f"{method} {rule}").strip("_")
+
+
+def report(stats: pstats.Stats, top: int = PROFILE_TOP) -> str:
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats("cumulative").print_stats(top)
+    return stream.getvalue()
+
+
+class ProfilerMiddleware:
+    # Wraps the whole WSGI call, so hooks, spec.validate, the view and the
+    # JSON provider all show up in the profile. Only one request is profiled
+    # at a time per process; others run normally meanwhile.
+    def __init__(
+        self,
+        wsgi_app,
+        url_map,
+        token: str = PROFILE_TOKEN,
+        profile_dir: str = PROFILE_DIR,
+        sample_every: int = PROFILE_SAMPLE_EVERY,
+        streamed_rules: tuple = STREAMED_RULES,
+    ):
+        self.wsgi_app = wsgi_app
+        self.url_map = url_map
+        self.token = token
+        self.profile_dir = profile_dir
+        self.sample_every = sample_every
+        self.streamed_rules = streamed_rules
+        self._requests = itertools.count(1)
+        self._lock = threading.Lock()
+        self._sampled = {}
+
+    def requested(self, environ: dict) -> bool:
+        if not self.token:
+            return False
+        sent = environ.get("HTTP_X_PROFILE", "")
+        return secrets.compare_digest(sent.encode(), self.token.encode())
+
+    def rule(self, environ: dict) -> str:
+        try:
+            rule, _ = self.url_map.bind_to_environ(environ).match(return_rule=True)
+        except HTTPException:
+            return "unmatched"
+        return rule.rule
+
+    def __call__(self, environ, start_response):
+        requested = self.requested(environ)
+        sampled = (
+            not requested
+            and self.sample_every > 0
+            and next(self._requests) % self.sample_every == 0
+        )
+        rule = self.rule(environ) if requested or sampled else None
+        if sampled and rule in self.streamed_rules:
+            sampled = False
+        if not (requested or sampled) or not self._lock.acquire(blocking=False):
+            return self.wsgi_app(environ, start_response)
+        route = route_slug(environ["REQUEST_METHOD"], rule)
+        try:
+            profiler, status, headers, body = self.profile(environ)
+            if sampled:
+                self.aggregate(route, profiler)
+        finally:
+            self._lock.release()
+
+        query = parse_qs(environ.get("QUERY_STRING", ""))
+        inline = (
+            environ.get("HTTP_X_PROFILE_OUTPUT") or query.get("profile_output", [""])[0]
+        )
+        if requested and inline == "inline":
+            start_response(
+                "200 OK",
+                [("Content-Type", "text/plain"), ("X-Profile-Status", status)],
+            )
+            return [report(pstats.Stats(profiler)).encode()]
+        if requested:
+            filename = f"{route}.{int(time.time() * 1000)}.{os.getpid()}.prof"
+            os.makedirs(self.profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profile_dir, filename))
+            headers = [*headers, ("X-Profile-File", filename)]
+        start_response(status, headers)
+        return [body]
+
+    def profile(self, environ: dict) -> tuple:
+        # The body is read inside the profile too, so a streamed response
+        # (an export profiled on request) is fully generated before being sent.
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = status
+            response["headers"] = headers
+            return lambda data: None
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            chunks = self.wsgi_app(environ, start_response)
+            try:
+                body = b"".join(chunks)
+            finally:
+                if hasattr(chunks, "close"):
+                    chunks.close()
+        finally:
+            profiler.disable()
+        return profiler, response["status"], response["headers"], body
+
+    def aggregate(self, route: str, profiler: cProfile.Profile) -> None:
+        # One file per route and worker; pstats.Stats(*files) merges workers
+        stats = self._sampled.get(route)
+        if stats is None:
+            stats = self._sampled[route] = pstats.Stats(profiler)
+        else:
+            stats.add(profiler)
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stats.dump_stats(
+            os.path.join(self.profile_dir, f"sampled-{route}.{os.getpid()}.prof")
+        )
@@ -0,0 +1,55 @@
+import re
+import unicodedata
+from typing import Iterable, List, Union
+
+SEARCH_FIELD = "_search"
+FILM_SEARCH_FIELDS = ("title", "director", "planets")
+PLANET_SEARCH_FIELDS = ("name", "films", "residents")
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+
+def normalize(value: str) -> str:
+    folded = "".join(
+        char
+        for char in unicodedata.normalize("NFKD", value)
+        if not unicodedata.combining(char)
+    )
+    return _NON_WORD.sub(" ", folded.casefold()).strip()
+
+
+def search_keys(value: Union[str, Iterable[str], None]) -> List[str]:
+    # "A New Hope" -> ["a new hope", "new hope", "hope"], so an anchored
+    # prefix match can start at any word while still using the index.
+    values = [value] if isinstance(value, str) else value or []
+    keys = []
+    for item in values:
+        words = normalize(item).split(" ")
+        keys.extend(" ".join(words[i:]) for i in range(len(words)) if words[i])
+    return sorted(set(keys))
+
+
+def search_fields(data: dict, fields: tuple) -> dict:
+    return {
+        f"{SEARCH_FIELD}.{field}": search_keys(data[field])
+        for field in fields
+        if field in data
+    }
+
+
+def search_document(data: dict, fields: tuple) -> dict:
+    return {field: search_keys(data.get(field)) for field in fields}
+
+
+def prefix_filter(value: str) -> dict:
+    # Case-sensitive and anchored on an already normalized field, so Mongo
+    # turns it into tight index bounds instead of scanning every key.
+    return {"$regex": "^" + re.escape(normalize(value))}
+
+
+def search_query(terms: dict) -> dict:
+    return {
+        f"{SEARCH_FIELD}.{field}": prefix_filter(value)
+        for field, value in terms.items()
+        if value
+    }
@@ -1,39 +1,339 @@
-from datetime import datetime
-from bson import ObjectId
-from flask import Flask, request, jsonify
-from flask.json.provider import DefaultJSONProvider
-from flask_pydantic_spec import FlaskPydanticSpec, Response, Request
+import hashlib
+import hmac
+import json
+import math
+import time
+from typing import List, Optional
+from functools import partial
+import click
+from flask import Flask, g, request, jsonify, stream_with_context
+from flask_pydantic_spec import FlaskPydanticSpec, Request
+from prometheus_client import CONTENT_TYPE_LATEST
+from pydantic import ValidationError
 
+from admin import admin_only
+from cache import response_cache
+from compression import (
+    COMPRESSIBLE_MIMETYPES,
+    ENCODINGS,
+    compress,
+    encoded_etag,
+    negotiate,
+)
+from db import (
+    MONGODB_MAX_POOL_SIZE,
+    MONGODB_MIN_POOL_SIZE,
+    READ_PRIMARY_SECRET,
+    READ_YOUR_WRITES_SECONDS,
+    SLOW_QUERY_REPORT_LIMIT,
+    MongoDBConnection,
+    pool_stats,
+    read_primary,
+    slow_queries,
+)
+from export import csv_chunks, ndjson_chunks
+from json_provider import build_json_provider
+from metrics import (
+    IN_FLIGHT,
+    REQUEST_LATENCY,
+    REQUESTS,
+    render as render_metrics,
+)
 from models import (
+    BulkOptions,
+    CacheStats,
     Error,
     Film,
     FilmCreated,
+    FilmExportFilter,
     FilmsResponse,
     FilmFilter,
     Message,
+    PartialFilmsResponse,
+    PartialPlanetsResponse,
     Planet,
     PlanetCreated,
+    PlanetsExportFilter,
     PlanetsFilter,
     PlanetsResponse,
+    PoolStats,
+    SlowQueryReport,
 )
-from service import FilmService, PlanetService
+from profiling import ProfilerMiddleware
+from service import FilmService, PlanetService, cacheable, next_cursor, object_id
+import timing
+from validation import Response, before, response_validator
+
+
+def make_etag(cache_key: str) -> str:
+    # The cache key carries the collection version and the normalized query,
+    # so the tag changes exactly when the list response can change.
+    return hashlib.sha1(cache_key.encode()).hexdigest()
+
+
+def matching_etag(etag: str) -> Optional[str]:
+    for candidate in (etag, *(encoded_etag(etag, e) for e in ENCODINGS)):
+        if request.if_none_match.contains(candidate):
+            return candidate
+    return None
+
+
+def json_response(body: bytes, etag: str, cache_key: str):
+    # compress_response stores its compressed copy next to the cached body
+    g.cache_key = cache_key
+    response = app.response_class(body, mimetype=app.json.mimetype)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def uncached(response, *names: str):
+    # Read from a secondary under a version a write bumped moments ago, so it
+    # may predate that write: neither the app, nginx nor the client keep it.
+    if not cacheable(*names):
+        response.headers["X-Accel-Expires"] = "0"
+        response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(etag: str):
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def bulk_rows(model, errors: list):
+    # NDJSON is read line by line from the request stream, so only one chunk
+    # of rows is ever held in memory; a JSON array has to be parsed whole.
+    if request.mimetype == "application/x-ndjson":
+        raw_rows = (line for line in request.stream if line.strip())
+    else:
+        raw_rows = request.get_json(silent=True)
+        if not isinstance(raw_rows, list):
+            raise ValueError("Expected a JSON array or an NDJSON body")
+
+    def rows():
+        for index, raw in enumerate(raw_rows):
+            try:
+                if isinstance(raw, bytes):
+                    raw = json.loads(raw)
+                yield index, model.parse_obj(raw).dict()
+            except ValueError as e:
+                errors.append({"index": index, "error": str(e)})
 
+    return rows()
 
-class MongoJsonProvider(DefaultJSONProvider):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.strftime("%Y-%m-%d %H:%M:%S")
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        return super().default(obj)
+
+def bulk_response(service, model):
+    try:
+        options = BulkOptions.parse_obj(request.args.to_dict())
+    except ValidationError as e:
+        return jsonify(e.errors()), 422
+    errors = []
+    try:
+        rows = bulk_rows(model, errors)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    result = service.bulk_save(rows, upsert=options.upsert)
+    result["errors"] = sorted(errors + result["errors"], key=lambda e: e["index"])
+    return jsonify(result), 200
+
+
+def invalid_id(value: str):
+    try:
+        object_id(value)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return None
+
+
+def ids_body(name: str, docs: List[dict]) -> dict:
+    return {name: docs, "total": len(docs), "page_count": 1, "has_next": False}
+
+
+def page_body(name: str, page: dict, query) -> dict:
+    total = page["total"]
+    page_count = None
+    if total is not None and query.page_size > 0:
+        page_count = math.ceil(total / query.page_size)
+    return {
+        name: page["items"],
+        "next_cursor": next_cursor(page["items"], query.order_by, query.page_size)
+        if page["has_next"]
+        else None,
+        "total": total,
+        "page_count": page_count,
+        "has_next": page["has_next"],
+    }
+
+
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+FILM_EXPORT_COLUMNS = ["_id", *FilmCreated.__fields__, "last_updated"]
+PLANET_EXPORT_COLUMNS = ["_id", *Planet.__fields__]
+
+
+def export_stream(first: str, chunks, export_format: str):
+    yield first
+    try:
+        yield from chunks
+    except Exception as e:
+        # The 200 is already sent. NDJSON readers get a last error line, and
+        # re-raising makes the server drop the connection instead of ending
+        # the chunked body, so the transfer fails rather than looking complete.
+        app.logger.exception("Export failed mid-stream")
+        if export_format == "ndjson":
+            yield app.json.dumps({"error": str(e)}) + "\n"
+        raise
+
+
+def export_response(docs, export_format: str, columns: list, filename: str):
+    dumps = partial(app.json.dumps, separators=(",", ":"))
+    if export_format == "csv":
+        chunks = csv_chunks(docs, columns, dumps)
+    else:
+        chunks = ndjson_chunks(docs, dumps)
+    # The first chunk (and so the query and its first batch) runs before any
+    # header is sent, so a query that fails outright still gets a 500.
+    first = next(chunks, "")
+    response = app.response_class(
+        stream_with_context(export_stream(first, chunks, export_format)),
+        mimetype=EXPORT_MIMETYPES[export_format],
+    )
+    response.headers[
+        "Content-Disposition"
+    ] = f"attachment; filename={filename}.{export_format}"
+    return response
 
 
 app = Flask(__name__)
-app.json = MongoJsonProvider(app)
+app.json = build_json_provider(app)
 spec = FlaskPydanticSpec(
-    "flask", title="API: Astromech's Protocol Interstellar", version="v1"
+    "flask",
+    title="API: Astromech's Protocol Interstellar",
+    version="v1",
+    before=before,
+    after=response_validator.after,
 )
 spec.register(app)
+# Outermost wrapper, so a profiled request covers every hook and the view
+app.wsgi_app = request_profiler = ProfilerMiddleware(app.wsgi_app, app.url_map)
+
+
+def route_label() -> str:
+    # The URL rule, not the path, so /films/<film_id> is a single series
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@app.before_request
+def start_metrics():
+    g.request_start = time.perf_counter()
+    g.metrics_route = route_label()
+    IN_FLIGHT.labels(request.method, g.metrics_route).inc()
+    # Request validation is timed from here to spec.validate's before hook
+    timing.begin(request.headers.get("X-Request-ID"))
+    timing.mark("dispatch")
+
+
+# Registered before every other after_request hook so it runs last and sees
+# the final status.
+@app.after_request
+def record_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+# Runs right before record_status, so the total covers compression too
+@app.after_request
+def server_timing(response):
+    timing.finish(response, request.method, g.get("metrics_route", "unmatched"))
+    return response
+
+
+@app.teardown_request
+def finish_metrics(exc):
+    if "request_start" not in g:
+        return
+    route = g.metrics_route
+    REQUEST_LATENCY.labels(request.method, route).observe(
+        time.perf_counter() - g.request_start
+    )
+    REQUESTS.labels(request.method, route, g.get("response_status", 500)).inc()
+    IN_FLIGHT.labels(request.method, route).dec()
+    timing.end()
+
+
+READ_PRIMARY_COOKIE = "read_primary_until"
+
+
+def cookie_signature(value: str) -> str:
+    return hmac.new(
+        READ_PRIMARY_SECRET.encode(), value.encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def read_primary_until(cookie: str) -> float:
+    # "<until>:<signature>"; anything else, forged or stale, is not pinned
+    value, _, signature = cookie.partition(":")
+    if not hmac.compare_digest(signature, cookie_signature(value)):
+        return 0
+    try:
+        return float(value)
+    except ValueError:
+        return 0
+
+
+@app.before_request
+def pin_reads_to_primary():
+    # Secondaries may lag behind the write a client just made, so for a short
+    # window after writing its list requests go to the primary instead.
+    until = read_primary_until(request.cookies.get(READ_PRIMARY_COOKIE, ""))
+    read_primary.set(until > time.time())
+
+
+@app.after_request
+def remember_write(response):
+    if (
+        READ_YOUR_WRITES_SECONDS > 0
+        and request.method in ("POST", "PUT", "DELETE")
+        and response.status_code < 400
+    ):
+        until = f"{time.time() + READ_YOUR_WRITES_SECONDS:.3f}"
+        response.set_cookie(
+            READ_PRIMARY_COOKIE,
+            f"{until}:{cookie_signature(until)}",
+            max_age=int(READ_YOUR_WRITES_SECONDS) + 1,
+            httponly=True,
+        )
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    if (
+        response.status_code != 200
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    encoding = negotiate(request.accept_encodings, len(body))
+    if encoding is None:
+        return response
+    cache_key = g.get("cache_key")
+    data = response_cache.get_encoded(cache_key, encoding) if cache_key else None
+    if data is None:
+        data = compress(body, encoding)
+        if cache_key:
+            response_cache.set_encoded(cache_key, encoding, data)
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(encoded_etag(etag, encoding), weak)
+    return response
 
 
 @app.get("/")
@@ -53,10 +353,34 @@ def create_film():
     )
 
 
+# Not wrapped in spec.validate: its request hook reads the whole body, which
+# would defeat streaming NDJSON. Query and rows are validated in bulk_response.
+@app.post("/films/bulk")
+def bulk_films():
+    return bulk_response(FilmService, FilmCreated)
+
+
+@app.get("/films/<film_id>")
+@spec.validate(resp=Response(HTTP_200=Film, HTTP_400=Error, HTTP_404=Error))
+def get_film(film_id):
+    try:
+        film_id = object_id(film_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return uncached(jsonify(FilmService.get(film_id)), "films"), 200
+    except ValueError as e:
+        return uncached(jsonify({"error": str(e)}), "films"), 404
+
+
 @app.put("/films/<film_id>")
-@spec.validate(body=Request(Film), resp=Response(HTTP_200=Message, HTTP_404=Error))
+@spec.validate(
+    body=Request(Film), resp=Response(HTTP_200=Message, HTTP_400=Error, HTTP_404=Error)
+)
 def edit_film(film_id):
     film_data = request.context.body.dict()
+    if error := invalid_id(film_id):
+        return error
     try:
         FilmService.update(film_id, film_data)
     except ValueError as e:
@@ -67,29 +391,76 @@ def edit_film(film_id):
 @app.get("/films")
 @spec.validate(
     query=FilmFilter,
-    resp=Response(HTTP_200=FilmsResponse),
+    resp=Response(HTTP_200=FilmsResponse, HTTP_400=Error, sparse=PartialFilmsResponse),
 )
 def list_films():
-    return (
-        jsonify(
-            {
-                "films": FilmService.list(
-                    title=request.context.query.title,
-                    director=request.context.query.director,
-                    order_by=request.context.query.order_by,
-                    page=request.context.query.page,
-                    page_size=request.context.query.page_size,
-                    planet=request.context.query.planet,
-                )
-            }
-        ),
-        200,
-    )
+    query = request.context.query
+    related = [query.expand] if query.expand else []
+    if query.ids:
+        try:
+            ids = [object_id(value) for value in query.ids]
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        body = ids_body("films", FilmService.get_many(ids))
+        if query.expand:
+            body["planets"] = FilmService.expand_planets(body["films"])
+        return uncached(jsonify(body), "films", *related), 200
+    cache_key = response_cache.key("films", query, query.expand)
+    etag = make_etag(cache_key)
+    # A pinned client skips the cache: with per-process caches, this worker
+    # may not have seen the bump for the write it just made.
+    if not read_primary.get():
+        if matched := matching_etag(etag):
+            return not_modified(matched)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return json_response(body, etag, cache_key), 200
+    try:
+        page = FilmService.page(
+            title=query.title,
+            director=query.director,
+            order_by=query.order_by,
+            page=query.page,
+            page_size=query.page_size,
+            planet=query.planet,
+            cursor=query.cursor,
+            fields=query.fields,
+            exclude=query.exclude,
+            include_total=query.include_total,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body = page_body("films", page, query)
+    if query.expand:
+        body["planets"] = FilmService.expand_planets(page["items"])
+    response = jsonify(body)
+    if not cacheable("films", *related):
+        return uncached(response, "films", *related), 200
+    response_cache.set(cache_key, response.get_data())
+    return json_response(response.get_data(), etag, cache_key), 200
+
+
+@app.get("/films/export")
+@spec.validate(query=FilmExportFilter, resp=Response("HTTP_200", HTTP_400=Error))
+def export_films():
+    query = request.context.query
+    try:
+        films = FilmService.export(
+            title=query.title,
+            director=query.director,
+            planet=query.planet,
+            order_by=query.order_by,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return export_response(films, query.format, FILM_EXPORT_COLUMNS, "films"), 200
 
 
 @app.delete("/films/<id_film>")
-@spec.validate(resp=Response(HTTP_200=Message, HTTP_404=Error))
+@spec.validate(resp=Response(HTTP_200=Message, HTTP_400=Error, HTTP_404=Error))
 def delete_film(id_film):
+    if error := invalid_id(id_film):
+        return error
     try:
         FilmService.delete(id_film)
     except ValueError as e:
@@ -108,10 +479,33 @@ def create_planet():
     )
 
 
+@app.post("/planets/bulk")
+def bulk_planets():
+    return bulk_response(PlanetService, Planet)
+
+
+@app.get("/planets/<planet_id>")
+@spec.validate(resp=Response(HTTP_200=Planet, HTTP_400=Error, HTTP_404=Error))
+def get_planet(planet_id):
+    try:
+        planet_id = object_id(planet_id)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return uncached(jsonify(PlanetService.get(planet_id)), "planets"), 200
+    except ValueError as e:
+        return uncached(jsonify({"error": str(e)}), "planets"), 404
+
+
 @app.put("/planets/<planet_id>")
-@spec.validate(body=Request(Planet), resp=Response(HTTP_200=Message, HTTP_404=Error))
+@spec.validate(
+    body=Request(Planet),
+    resp=Response(HTTP_200=Message, HTTP_400=Error, HTTP_404=Error),
+)
 def edit_planet(planet_id):
     planet_data = request.context.body.dict()
+    if error := invalid_id(planet_id):
+        return error
     try:
         PlanetService.update(planet_id, planet_data)
     except ValueError as e:
@@ -120,28 +514,83 @@ def edit_planet(planet_id):
 
 
 @app.get("/planets")
-@spec.validate(query=PlanetsFilter, resp=Response(HTTP_200=PlanetsResponse))
+@spec.validate(
+    query=PlanetsFilter,
+    resp=Response(
+        HTTP_200=PlanetsResponse, HTTP_400=Error, sparse=PartialPlanetsResponse
+    ),
+)
 def list_planets():
+    query = request.context.query
+    related = [query.expand] if query.expand else []
+    if query.ids:
+        try:
+            ids = [object_id(value) for value in query.ids]
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        body = ids_body("planets", PlanetService.get_many(ids))
+        if query.expand:
+            body["films"] = PlanetService.expand_films(body["planets"])
+        return uncached(jsonify(body), "planets", *related), 200
+    cache_key = response_cache.key("planets", query, query.expand)
+    etag = make_etag(cache_key)
+    # A pinned client skips the cache: with per-process caches, this worker
+    # may not have seen the bump for the write it just made.
+    if not read_primary.get():
+        if matched := matching_etag(etag):
+            return not_modified(matched)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return json_response(body, etag, cache_key), 200
+    try:
+        page = PlanetService.page(
+            name=query.name,
+            page=query.page,
+            page_size=query.page_size,
+            film=query.film,
+            order_by=query.order_by,
+            resident=query.resident,
+            cursor=query.cursor,
+            fields=query.fields,
+            exclude=query.exclude,
+            include_total=query.include_total,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    body = page_body("planets", page, query)
+    if query.expand:
+        body["films"] = PlanetService.expand_films(page["items"])
+    response = jsonify(body)
+    if not cacheable("planets", *related):
+        return uncached(response, "planets", *related), 200
+    response_cache.set(cache_key, response.get_data())
+    return json_response(response.get_data(), etag, cache_key), 200
+
+
+@app.get("/planets/export")
+@spec.validate(query=PlanetsExportFilter, resp=Response("HTTP_200", HTTP_400=Error))
+def export_planets():
+    query = request.context.query
+    try:
+        planets = PlanetService.export(
+            name=query.name,
+            film=query.film,
+            resident=query.resident,
+            order_by=query.order_by,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     return (
-        jsonify(
-            {
-                "planets": PlanetService.list(
-                    name=request.context.query.name,
-                    page=request.context.query.page,
-                    page_size=request.context.query.page_size,
-                    film=request.context.query.film,
-                    order_by=request.context.query.order_by,
-                    resident=request.context.query.resident,
-                )
-            }
-        ),
+        export_response(planets, query.format, PLANET_EXPORT_COLUMNS, "planets"),
         200,
     )
 
 
 @app.delete("/planets/<id_planet>")
-@spec.validate(resp=Response(HTTP_200=Message, HTTP_404=Error))
+@spec.validate(resp=Response(HTTP_200=Message, HTTP_400=Error, HTTP_404=Error))
 def delete_planet(id_planet):
+    if error := invalid_id(id_planet):
+        return error
     try:
         PlanetService.delete(id_planet)
     except ValueError as e:
@@ -149,6 +598,72 @@ def delete_planet(id_planet):
     return jsonify({"message": "Planet deleted successfully!"}), 200
 
 
+@app.get("/cache/stats")
+@admin_only
+@spec.validate(resp=Response(HTTP_200=CacheStats, HTTP_401=Error, HTTP_404=Error))
+def cache_stats():
+    return jsonify(response_cache.stats()), 200
+
+
+@app.get("/db/pool")
+@admin_only
+@spec.validate(resp=Response(HTTP_200=PoolStats, HTTP_401=Error, HTTP_404=Error))
+def db_pool_stats():
+    return (
+        jsonify(
+            {
+                **pool_stats.snapshot(),
+                "max_pool_size": MONGODB_MAX_POOL_SIZE,
+                "min_pool_size": MONGODB_MIN_POOL_SIZE,
+            }
+        ),
+        200,
+    )
+
+
+@app.get("/db/slow-queries")
+@admin_only
+@spec.validate(resp=Response(HTTP_200=SlowQueryReport, HTTP_401=Error, HTTP_404=Error))
+def slow_query_report():
+    return jsonify(slow_queries.report()), 200
+
+
+# Prometheus text format, so not wrapped in spec.validate
+@app.get("/metrics")
+@admin_only
+def metrics():
+    return render_metrics(), 200, {"Content-Type": CONTENT_TYPE_LATEST}
+
+
+@app.cli.command("ensure-indexes")
+def ensure_indexes():
+    for collection, names in MongoDBConnection.ensure_indexes().items():
+        click.echo(f"{collection}: {', '.join(names)}")
+
+
+@app.cli.command("slow-queries")
+@click.option("--limit", default=SLOW_QUERY_REPORT_LIMIT, show_default=True)
+def slow_queries_command(limit):
+    report = slow_queries.report(limit)
+    click.echo(f"threshold: {report['threshold_ms']} ms")
+    for shape in report["shapes"]:
+        click.echo(
+            f"{shape['collection']} {shape['operation']}"
+            f" fields={','.join(shape['fields']) or '-'} sort={shape['sort'] or '-'}"
+            f" count={shape['count']} avg={shape['avg_ms']}ms max={shape['max_ms']}ms"
+            f" collscan={shape['collscan']}/{shape['explained']}"
+            f" in_memory_sort={shape['in_memory_sort']}/{shape['explained']}"
+        )
+        if shape["plan"]:
+            click.echo(f"  plan: {' <- '.join(shape['plan']['stages'])}")
+
+
+@app.cli.command("backfill-search")
+def backfill_search():
+    click.echo(f"films: {FilmService.backfill_search()} updated")
+    click.echo(f"planets: {PlanetService.backfill_search()} updated")
+
+
 @app.errorhandler(Exception)
 def handle_exception(e):
     return jsonify(error=str(e)), 500
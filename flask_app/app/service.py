@@ -1,22 +1,453 @@
-from typing import List, Optional
-from bson import ObjectId
-from db import MongoDBConnection
+import base64
+import os
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+from bson import ObjectId, json_util
+from bson.errors import BSONError, InvalidId
+from cache import response_cache
+from pymongo import ASCENDING, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from db import (
+    FILTER_FIELDS,
+    SORT_FIELDS,
+    MongoDBConnection,
+    read_primary,
+    reads_from_primary,
+    slow_queries,
+    sort_index,
+)
 from models import now_str
+from search import (
+    FILM_SEARCH_FIELDS,
+    PLANET_SEARCH_FIELDS,
+    SEARCH_FIELD,
+    search_document,
+    search_fields,
+    search_query,
+)
+
+BACKFILL_BATCH_SIZE = 500
+BULK_CHUNK_SIZE = 1000
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+
+
+def encode_cursor(doc: dict, order_by: str) -> str:
+    raw = json_util.dumps([order_by, doc.get(order_by.lstrip("-")), doc["_id"]])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str, order_by: str) -> tuple:
+    # Cursors come back from clients, so anything json_util can choke on
+    # (bad $oid, malformed $date, ...) is a bad request, not a server error
+    try:
+        decoded = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, LookupError, BSONError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(decoded, list) or len(decoded) != 3:
+        raise ValueError("Invalid cursor")
+    cursor_order_by, value, last_id = decoded
+    if cursor_order_by != order_by:
+        raise ValueError("Cursor does not match order_by")
+    return value, last_id
+
+
+def object_id(value: str) -> ObjectId:
+    try:
+        return ObjectId(value)
+    except (InvalidId, TypeError):
+        raise ValueError(f"Invalid ID: {value}")
+
+
+def next_cursor(docs: List[dict], order_by: str, page_size: int) -> Optional[str]:
+    if not docs or len(docs) < page_size:
+        return None
+    return encode_cursor(docs[-1], order_by)
+
+
+def parse_order_by(collection, order_by: str) -> Tuple[str, int]:
+    field = order_by
+    d = 1
+    if order_by[0] == "-":
+        field = order_by[1:]
+        d = -1
+    if field not in SORT_FIELDS[collection.name]:
+        raise ValueError(f"Invalid order_by: {order_by}")
+    return field, d
+
+
+def projection(
+    field: str,
+    fields: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+) -> dict:
+    # _id and the sort key are always returned so next_cursor can be built
+    if fields:
+        return {**dict.fromkeys(fields, 1), field: 1, "_id": 1}
+    return {
+        SEARCH_FIELD: 0,
+        **{name: 0 for name in exclude or [] if name not in (field, "_id")},
+    }
+
+
+def keyset_query(field: str, d: int, value, last_id) -> dict:
+    # Missing and null values sort before everything else, and $gt/$lt never
+    # match them, so the null bracket needs branches of its own: ascending it
+    # is left for the non-null values, descending it follows them.
+    op = "$gt" if d == 1 else "$lt"
+    clauses = [{field: value, "_id": {op: last_id}}]
+    if value is None:
+        if d == 1:
+            clauses.append({field: {"$ne": None}})
+    else:
+        clauses.append({field: {op: value}})
+        if d == -1:
+            clauses.append({field: None})
+    return {"$or": clauses}
+
+
+def filter_hint(collection, filter_query: dict) -> Optional[list]:
+    # A search filter is far more selective than the sort key, so the matches
+    # are found (and counted) through its index.
+    return next(
+        (
+            [(key, ASCENDING)]
+            for key in filter_query
+            if key in FILTER_FIELDS[collection.name]
+        ),
+        None,
+    )
+
+
+def index_hint(collection, filter_query: dict, field: str) -> list:
+    # Filtered, Mongo sorts only the few matches (a top-k sort for a page).
+    # Unfiltered, walking the sort index returns documents already in order,
+    # so pages stop at their limit and exports stream with no blocking sort.
+    return filter_hint(collection, filter_query) or sort_index(field)
+
+
+def sort_keys(field: str, d: int) -> list:
+    return [(field, d), ("_id", d)]
+
+
+def sorted_find(
+    collection,
+    filter_query: dict,
+    field: str,
+    d: int,
+    fields: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+):
+    return (
+        collection.find(filter_query, projection(field, fields, exclude))
+        .sort(sort_keys(field, d))
+        .hint(index_hint(collection, filter_query, field))
+    )
+
+
+def explain(collection, command: dict, hint: Optional[list] = None) -> dict:
+    # queryPlanner only: Cursor.explain() defaults to allPlansExecution, which
+    # runs every candidate plan again for a query that was already slow.
+    if hint:
+        command = {**command, "hint": dict(hint)}
+    return collection.database.command("explain", command, verbosity="queryPlanner")
+
+
+def fetch(
+    collection,
+    cursor,
+    filter_query: dict,
+    sort: Optional[list] = None,
+    skip: int = 0,
+    limit: int = 0,
+    hint: Optional[list] = None,
+) -> List[dict]:
+    command = {"find": collection.name, "filter": filter_query}
+    if sort:
+        command["sort"] = dict(sort)
+    if skip:
+        command["skip"] = skip
+    if limit:
+        command["limit"] = limit
+    # Timed around the iteration, since a find only runs on the first next()
+    with slow_queries.track(
+        collection,
+        "find",
+        filter_query,
+        sort,
+        skip,
+        limit,
+        lambda: explain(collection, command, hint),
+    ):
+        return list(cursor)
+
+
+def count(collection, filter_query: dict) -> int:
+    hint = filter_hint(collection, filter_query)
+    command = {"count": collection.name, "query": filter_query}
+    with slow_queries.track(
+        collection,
+        "count",
+        filter_query,
+        explain=lambda: explain(collection, command, hint),
+    ):
+        if hint:
+            return collection.count_documents(filter_query, hint=hint)
+        return collection.count_documents(filter_query)
+
+
+def cacheable(*names: str) -> bool:
+    # Entries are keyed on the version a write bumped, but a secondary may not
+    # have that write yet: until it settles only primary reads are stored.
+    return reads_from_primary() or response_cache.settled(*names)
+
+
+def paginate(
+    collection,
+    filter_query: dict,
+    order_by: str,
+    page: int,
+    page_size: int,
+    cursor: Optional[str],
+    fields: Optional[List[str]] = None,
+    exclude: Optional[List[str]] = None,
+    include_total: bool = False,
+) -> dict:
+    field, d = parse_order_by(collection, order_by)
+
+    skip = (page - 1) * page_size
+    keyset = None
+    if cursor:
+        # Keyset pagination: resume right after the last (order_by, _id) seen,
+        # so deep pages cost the same as the first one.
+        value, last_id = decode_cursor(cursor, order_by)
+        keyset = keyset_query(field, d, value, last_id)
+        skip = 0
+
+    # Counts are cached under the collection version, so every write through
+    # the services invalidates them together with the cached pages.
+    total = None
+    if include_total:
+        total = response_cache.get_count(collection.name, filter_query)
+    if include_total and total is None:
+        if filter_query:
+            total = count(collection, filter_query)
+        else:
+            total = collection.estimated_document_count()
+        if cacheable(collection.name):
+            response_cache.set_count(collection.name, filter_query, total)
+
+    # One extra document tells whether there is a next page
+    query = {**filter_query, **(keyset or {})}
+    docs = fetch(
+        collection,
+        sorted_find(collection, query, field, d, fields, exclude)
+        .skip(skip)
+        .limit(page_size + 1),
+        query,
+        sort_keys(field, d),
+        skip,
+        page_size + 1,
+        index_hint(collection, query, field),
+    )
+    return {
+        "items": docs[:page_size],
+        "total": total,
+        "has_next": len(docs) > page_size,
+    }
+
+
+def find_by_ids(collection, ids: List[ObjectId]) -> List[dict]:
+    # Cached documents are served as is; the rest come from a single $in
+    # lookup on _id. A client pinned to the primary skips the cache.
+    docs = {}
+    if not read_primary.get():
+        for doc_id in ids:
+            doc = response_cache.get_document(collection.name, doc_id)
+            if doc is not None:
+                docs[doc_id] = doc
+    missing = [doc_id for doc_id in ids if doc_id not in docs]
+    if missing:
+        query = {"_id": {"$in": missing}}
+        store = cacheable(f"{collection.name}:documents")
+        version = response_cache.documents_version(collection.name)
+        for doc in fetch(collection, collection.find(query, {SEARCH_FIELD: 0}), query):
+            if store:
+                response_cache.set_document(collection.name, doc, version)
+            docs[doc["_id"]] = doc
+    return [docs[doc_id] for doc_id in dict.fromkeys(ids) if doc_id in docs]
+
+
+def related(collection, key: str, values: Iterable[str], order_by: str) -> List[dict]:
+    # One $in query for the whole page instead of one lookup per row
+    names = sorted(set(values))
+    if not names:
+        return []
+    query = {key: {"$in": names}}
+    sort = sort_keys(order_by, ASCENDING)
+    return fetch(
+        collection, collection.find(query, {SEARCH_FIELD: 0}).sort(sort), query, sort
+    )
+
+
+def export(collection, filter_query: dict, order_by: str) -> Iterator[dict]:
+    field, d = parse_order_by(collection, order_by)
+    cursor = sorted_find(collection, filter_query, field, d).batch_size(
+        EXPORT_BATCH_SIZE
+    )
+    # A filtered export sorts all its matches before the first batch, which
+    # may not fit in the in-memory sort limit.
+    return cursor.allow_disk_use(bool(filter_hint(collection, filter_query)))
+
+
+def backfill_search(collection, fields: tuple) -> int:
+    updated = 0
+    requests = []
+    for doc in collection.find({}, {field: 1 for field in fields}):
+        requests.append(
+            UpdateOne(
+                {"_id": doc["_id"]},
+                {"$set": {SEARCH_FIELD: search_document(doc, fields)}},
+            )
+        )
+        if len(requests) == BACKFILL_BATCH_SIZE:
+            updated += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        updated += collection.bulk_write(requests, ordered=False).modified_count
+    response_cache.bump(collection.name)
+    response_cache.bump_documents(collection.name)
+    return updated
+
+
+def bulk_request(doc: dict, fields: tuple, natural_key: Optional[str]):
+    doc = {**doc, SEARCH_FIELD: search_document(doc, fields)}
+    if natural_key is None:
+        return InsertOne(doc)
+    update = {"$set": {**doc, "last_updated": now_str()}}
+    if "created" in doc:
+        update["$setOnInsert"] = {"created": update["$set"].pop("created")}
+    return UpdateOne({natural_key: doc[natural_key]}, update, upsert=True)
+
+
+def bulk_save(
+    collection,
+    rows: Iterable[Tuple[int, dict]],
+    fields: tuple,
+    natural_key: Optional[str] = None,
+) -> dict:
+    # rows are (position in the payload, document) pairs, so write errors can
+    # be reported against the row the client sent.
+    result = {"inserted": 0, "upserted": 0, "modified": 0, "errors": []}
+    rows = iter(rows)
+    while chunk := list(islice(rows, BULK_CHUNK_SIZE)):
+        requests = [bulk_request(doc, fields, natural_key) for _, doc in chunk]
+        try:
+            details = collection.bulk_write(requests, ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            result["errors"].extend(
+                {"index": chunk[error["index"]][0], "error": error["errmsg"]}
+                for error in details["writeErrors"]
+            )
+        result["inserted"] += details["nInserted"]
+        result["upserted"] += details["nUpserted"]
+        result["modified"] += details["nModified"]
+        response_cache.bump(collection.name)
+        response_cache.bump_documents(collection.name)
+    return result
 
 
 class FilmService:
     @staticmethod
     def create(film_data: dict) -> ObjectId:
-        return MongoDBConnection.films().insert_one(film_data).inserted_id
+        film_id = (
+            MongoDBConnection.films()
+            .insert_one(
+                {
+                    **film_data,
+                    SEARCH_FIELD: search_document(film_data, FILM_SEARCH_FIELDS),
+                }
+            )
+            .inserted_id
+        )
+        response_cache.bump("films")
+        return film_id
 
     @staticmethod
     def update(film_id: str, film_data: dict) -> None:
         result = MongoDBConnection.films().update_one(
             {"_id": ObjectId(film_id)},
-            {"$set": {**film_data, "last_updated": now_str()}},
+            {
+                "$set": {
+                    **film_data,
+                    **search_fields(film_data, FILM_SEARCH_FIELDS),
+                    "last_updated": now_str(),
+                }
+            },
         )
         if result.matched_count == 0:
             raise ValueError(f"Film not found with ID: {film_id}")
+        response_cache.bump("films")
+        response_cache.bump_documents("films")
+
+    @staticmethod
+    def backfill_search() -> int:
+        return backfill_search(MongoDBConnection.films(), FILM_SEARCH_FIELDS)
+
+    @staticmethod
+    def bulk_save(rows: Iterable[Tuple[int, dict]], upsert: bool = False) -> dict:
+        return bulk_save(
+            MongoDBConnection.films(),
+            rows,
+            FILM_SEARCH_FIELDS,
+            "episode_id" if upsert else None,
+        )
+
+    @staticmethod
+    def filter_query(
+        title: Optional[str] = None,
+        director: Optional[str] = None,
+        planet: Optional[str] = None,
+    ) -> dict:
+        return search_query({"title": title, "director": director, "planets": planet})
+
+    @staticmethod
+    def export(
+        title: Optional[str] = None,
+        director: Optional[str] = None,
+        planet: Optional[str] = None,
+        order_by: str = "episode_id",
+    ) -> Iterator[dict]:
+        return export(
+            MongoDBConnection.films("read"),
+            FilmService.filter_query(title, director, planet),
+            order_by,
+        )
+
+    @staticmethod
+    def page(
+        title: Optional[str] = None,
+        director: Optional[str] = None,
+        order_by: str = "episode_id",
+        page: int = 1,
+        page_size: int = 10,
+        planet: Optional[str] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+        include_total: bool = False,
+    ) -> dict:
+        return paginate(
+            MongoDBConnection.films("read"),
+            FilmService.filter_query(title, director, planet),
+            order_by,
+            page,
+            page_size,
+            cursor,
+            fields,
+            exclude,
+            include_total,
+        )
 
     @staticmethod
     def list(
@@ -26,58 +457,142 @@ class FilmService:
         page: int = 1,
         page_size: int = 10,
         planet: Optional[str] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
     ) -> List[dict]:
-        filter_query = {}
-        if title:
-            filter_query["title"] = {
-                "$regex": title,
-                "$options": "i",
-            }
-        if director:
-            filter_query["director"] = {
-                "$regex": director,
-                "$options": "i",
-            }
-        if planet:
-            filter_query["planets"] = {
-                "$regex": planet,
-                "$options": "i",
-            }
-
-        d = 1
-        if order_by[0] == "-":
-            order_by = order_by[1:]
-            d = -1
-
-        skip = (page - 1) * page_size
-        return list(
-            MongoDBConnection.films()
-            .find(filter_query)
-            .sort(order_by, d)
-            .skip(skip)
-            .limit(page_size)
+        return FilmService.page(
+            title,
+            director,
+            order_by,
+            page,
+            page_size,
+            planet,
+            cursor,
+            fields,
+            exclude,
+        )["items"]
+
+    @staticmethod
+    def expand_planets(films: List[dict]) -> List[dict]:
+        return related(
+            MongoDBConnection.planets("read"),
+            "name",
+            (name for film in films for name in film.get("planets") or []),
+            "name",
         )
 
+    @staticmethod
+    def get(film_id: ObjectId) -> dict:
+        docs = find_by_ids(MongoDBConnection.films("read"), [film_id])
+        if not docs:
+            raise ValueError(f"Film not found with ID: {film_id}")
+        return docs[0]
+
+    @staticmethod
+    def get_many(ids: List[ObjectId]) -> List[dict]:
+        return find_by_ids(MongoDBConnection.films("read"), ids)
+
     @staticmethod
     def delete(film_id: str) -> None:
         result = MongoDBConnection.films().delete_one({"_id": ObjectId(film_id)})
         if result.deleted_count == 0:
             raise ValueError(f"Film not found with ID: {film_id}")
+        response_cache.bump("films")
+        response_cache.bump_documents("films")
 
 
 class PlanetService:
     @staticmethod
     def create(planet_data: dict) -> ObjectId:
-        return MongoDBConnection.planets().insert_one(planet_data).inserted_id
+        planet_id = (
+            MongoDBConnection.planets()
+            .insert_one(
+                {
+                    **planet_data,
+                    SEARCH_FIELD: search_document(planet_data, PLANET_SEARCH_FIELDS),
+                }
+            )
+            .inserted_id
+        )
+        response_cache.bump("planets")
+        return planet_id
 
     @staticmethod
     def update(planet_id: str, planet_data: dict) -> None:
         result = MongoDBConnection.planets().update_one(
             {"_id": ObjectId(planet_id)},
-            {"$set": {**planet_data, "last_updated": now_str()}},
+            {
+                "$set": {
+                    **planet_data,
+                    **search_fields(planet_data, PLANET_SEARCH_FIELDS),
+                    "last_updated": now_str(),
+                }
+            },
         )
         if result.matched_count == 0:
             raise ValueError(f"Planet not found with ID: {planet_id}")
+        response_cache.bump("planets")
+        response_cache.bump_documents("planets")
+
+    @staticmethod
+    def backfill_search() -> int:
+        return backfill_search(MongoDBConnection.planets(), PLANET_SEARCH_FIELDS)
+
+    @staticmethod
+    def bulk_save(rows: Iterable[Tuple[int, dict]], upsert: bool = False) -> dict:
+        return bulk_save(
+            MongoDBConnection.planets(),
+            rows,
+            PLANET_SEARCH_FIELDS,
+            "name" if upsert else None,
+        )
+
+    @staticmethod
+    def filter_query(
+        name: Optional[str] = None,
+        film: Optional[str] = None,
+        resident: Optional[str] = None,
+    ) -> dict:
+        return search_query({"name": name, "films": film, "residents": resident})
+
+    @staticmethod
+    def export(
+        name: Optional[str] = None,
+        film: Optional[str] = None,
+        resident: Optional[str] = None,
+        order_by: str = "name",
+    ) -> Iterator[dict]:
+        return export(
+            MongoDBConnection.planets("read"),
+            PlanetService.filter_query(name, film, resident),
+            order_by,
+        )
+
+    @staticmethod
+    def page(
+        name: Optional[str],
+        page: int = 1,
+        page_size: int = 10,
+        film: Optional[str] = None,
+        order_by: Optional[str] = "name",
+        resident: Optional[str] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
+        include_total: bool = False,
+    ) -> dict:
+        return paginate(
+            MongoDBConnection.planets("read"),
+            PlanetService.filter_query(name, film, resident),
+            order_by,
+            page,
+            page_size,
+            cursor,
+            fields,
+            exclude,
+            include_total,
+        )
 
     @staticmethod
     def list(
@@ -87,31 +602,46 @@ class PlanetService:
         film: Optional[str] = None,
         order_by: Optional[str] = "name",
         resident: Optional[str] = None,
+        cursor: Optional[str] = None,
+        fields: Optional[List[str]] = None,
+        exclude: Optional[List[str]] = None,
     ) -> List[dict]:
-        filter_query = {}
-        if name:
-            filter_query["name"] = {"$regex": name, "$options": "i"}
-        if film:
-            filter_query["films"] = {"$regex": film, "$options": "i"}
-        if resident:
-            filter_query["residents"] = {"$regex": resident, "$options": "i"}
-
-        d = 1
-        if order_by[0] == "-":
-            order_by = order_by[1:]
-            d = -1
-
-        skip = (page - 1) * page_size
-        return list(
-            MongoDBConnection.planets()
-            .find(filter_query)
-            .sort(order_by, d)
-            .skip(skip)
-            .limit(page_size)
+        return PlanetService.page(
+            name,
+            page,
+            page_size,
+            film,
+            order_by,
+            resident,
+            cursor,
+            fields,
+            exclude,
+        )["items"]
+
+    @staticmethod
+    def expand_films(planets: List[dict]) -> List[dict]:
+        return related(
+            MongoDBConnection.films("read"),
+            "title",
+            (title for planet in planets for title in planet.get("films") or []),
+            "episode_id",
         )
 
+    @staticmethod
+    def get(planet_id: ObjectId) -> dict:
+        docs = find_by_ids(MongoDBConnection.planets("read"), [planet_id])
+        if not docs:
+            raise ValueError(f"Planet not found with ID: {planet_id}")
+        return docs[0]
+
+    @staticmethod
+    def get_many(ids: List[ObjectId]) -> List[dict]:
+        return find_by_ids(MongoDBConnection.planets("read"), ids)
+
     @staticmethod
     def delete(planet_id: str) -> None:
         result = MongoDBConnection.planets().delete_one({"_id": ObjectId(planet_id)})
         if result.deleted_count == 0:
             raise ValueError(f"Planet not found with ID: {planet_id}")
+        response_cache.bump("planets")
+        response_cache.bump_documents("planets")
@@ -0,0 +1,134 @@
+import json
+import logging
+import os
+import re
+import secrets
+import sys
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+from flask import Response
+
+# Server-Timing header and one JSON log line per request
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true") == "true"
+TIMING_LOG = os.getenv("TIMING_LOG", "true") == "true"
+PHASES = ("validation", "mongo", "serialization", "response_validation")
+# An X-Request-ID from nginx (or the client) is kept when it looks sane
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._-]{1,128}")
+
+logger = logging.getLogger("timing")
+if TIMING_LOG and not logger.handlers:
+    # Bare JSON lines on stderr, which uWSGI writes to its log
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class Timings:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+        self.marks = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] += seconds
+
+    def mark(self, name: str) -> None:
+        self.marks[name] = time.perf_counter()
+
+    def since(self, name: str, phase: str) -> None:
+        start = self.marks.pop(name, None)
+        if start is not None:
+            self.add(phase, time.perf_counter() - start)
+
+    def total(self) -> float:
+        return time.perf_counter() - self.start
+
+    def header(self, total: float) -> str:
+        return ", ".join(
+            f"{name};dur={seconds * 1000:.3f}"
+            for name, seconds in (*self.phases.items(), ("total", total))
+        )
+
+    def log_line(self, method: str, route: str, status: int, total: float) -> str:
+        # Formatted by hand: it runs on every request and json.dumps with a
+        # dict built for it costs several times more. Only the route (from the
+        # app's URL rules) could ever need escaping.
+        phases = "".join(
+            f',"{name}_ms":{seconds * 1000:.3f}'
+            for name, seconds in self.phases.items()
+        )
+        return (
+            f'{{"request_id":"{self.request_id}","method":"{method}",'
+            f'"route":{json.dumps(route)},"status":{status},'
+            f'"total_ms":{total * 1000:.3f}{phases}}}'
+        )
+
+
+current = ContextVar("timings", default=None)
+
+
+def request_id(incoming: Optional[str]) -> str:
+    if incoming and _REQUEST_ID.fullmatch(incoming):
+        return incoming
+    return secrets.token_hex(16)
+
+
+def begin(incoming_id: Optional[str] = None) -> Optional[Timings]:
+    timings = Timings(request_id(incoming_id)) if SERVER_TIMING else None
+    current.set(timings)
+    return timings
+
+
+def finish(response: Response, method: str, route: str) -> None:
+    timings = current.get()
+    if timings is None:
+        return
+    total = timings.total()
+    response.headers["Server-Timing"] = timings.header(total)
+    response.headers["X-Request-ID"] = timings.request_id
+    if TIMING_LOG:
+        logger.info(timings.log_line(method, route, response.status_code, total))
+
+
+def end() -> None:
+    # uWSGI reuses threads; work done between requests is not timed
+    current.set(None)
+
+
+# The helpers below are called from db.py, json_provider.py and validation.py
+# and do nothing outside a timed request (CLI commands, tests without hooks).
+def add(phase: str, seconds: float) -> None:
+    timings = current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+def mark(name: str) -> None:
+    timings = current.get()
+    if timings is not None:
+        timings.mark(name)
+
+
+def since(name: str, phase: str) -> None:
+    timings = current.get()
+    if timings is not None:
+        timings.since(name, phase)
+
+
+@contextmanager
+def measure(phase: str):
+    timings = current.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(phase, time.perf_counter() - start)
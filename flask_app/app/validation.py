@@ -0,0 +1,107 @@
+import logging
+import os
+import random
+from typing import Optional
+
+from flask import current_app, request
+from flask_pydantic_spec import Response as SpecResponse
+from flask_pydantic_spec.utils import default_after_handler, default_before_handler
+from pydantic import ValidationError
+
+import timing
+
+RESPONSE_VALIDATION_MODES = ("off", "sampled", "strict")
+RESPONSE_VALIDATION = os.getenv("RESPONSE_VALIDATION", "strict")
+RESPONSE_VALIDATION_SAMPLE_RATE = float(
+    os.getenv("RESPONSE_VALIDATION_SAMPLE_RATE", 0.01)
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseValidator:
+    def __init__(
+        self,
+        mode: str = RESPONSE_VALIDATION,
+        sample_rate: float = RESPONSE_VALIDATION_SAMPLE_RATE,
+    ):
+        self.configure(mode, sample_rate)
+        self.validated = 0
+        self.violations = 0
+
+    def configure(self, mode: str, sample_rate: Optional[float] = None) -> None:
+        if mode not in RESPONSE_VALIDATION_MODES:
+            modes = ", ".join(RESPONSE_VALIDATION_MODES)
+            raise ValueError(f"RESPONSE_VALIDATION must be one of: {modes}")
+        self.mode = mode
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+
+    def after(self, req, resp, resp_validation_error, instance) -> None:
+        # spec.validate "after" hook: strict mode already validated (and
+        # failed) the response inline; sampled mode checks a fraction of
+        # responses here and only logs what it finds.
+        default_after_handler(req, resp, resp_validation_error, instance)
+        if self.mode == "sampled" and random.random() < self.sample_rate:
+            self.sample(req, resp)
+        # Either way the validation started when find_model was called
+        timing.since("response", "response_validation")
+
+    def sample(self, req, resp) -> None:
+        endpoint = current_app.view_functions.get(req.endpoint)
+        spec_resp = getattr(endpoint, "resp", None)
+        model = spec_resp.find_model(resp.status_code) if spec_resp else None
+        if model is None:
+            return
+        self.validated += 1
+        try:
+            model.validate(resp.get_json())
+        except ValidationError as e:
+            self.violations += 1
+            logger.warning(
+                "Response validation error on %s %s: %s",
+                req.method,
+                req.path,
+                e.errors(),
+            )
+
+
+response_validator = ResponseValidator()
+
+
+def before(req, resp, req_validation_error, instance) -> None:
+    # spec.validate "before" hook, called as soon as the request is validated
+    default_before_handler(req, resp, req_validation_error, instance)
+    timing.since("dispatch", "validation")
+
+
+class Response(SpecResponse):
+    # Same as flask_pydantic_spec.Response, but inline (blocking) validation
+    # only happens in strict mode. Request validation is unaffected. A 200
+    # asked for with a sparse fieldset (fields= / exclude=) is checked against
+    # the sparse model, every other one against the full HTTP_200 model.
+    def __init__(self, *args, sparse=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.sparse = sparse
+
+    @property
+    def validate(self) -> bool:
+        return self._validate and response_validator.mode == "strict"
+
+    @validate.setter
+    def validate(self, value: bool) -> None:
+        self._validate = value
+
+    def find_model(self, code: int):
+        # Called right after the view returns, before the body is parsed back
+        # and validated.
+        timing.mark("response")
+        query = getattr(getattr(request, "context", None), "query", None)
+        sparse = getattr(query, "fields", None) or getattr(query, "exclude", None)
+        if code == 200 and self.sparse and sparse:
+            return self.sparse
+        return super().find_model(code)
+
+    @property
+    def models(self) -> list:
+        return [*super().models, *([self.sparse] if self.sparse else [])]
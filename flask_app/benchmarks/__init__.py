@@ -0,0 +1,4 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.getcwd(), "app"))
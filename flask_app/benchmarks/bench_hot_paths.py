@@ -0,0 +1,108 @@
+# Micro-benchmarks for the pieces of a list request. Not collected by the
+# functional suite (bench_*.py); run them explicitly:
+#
+#   cd flask_app && pytest benchmarks/bench_hot_paths.py --benchmark-save=baseline
+#   cd flask_app && pytest benchmarks/bench_hot_paths.py \
+#       --benchmark-compare --benchmark-compare-fail=median:15%
+import pytest
+
+from json_provider import MongoJsonProvider, OrjsonProvider, orjson
+from models import FilmFilter, Planet, PlanetsFilter, PlanetsResponse
+from server import app
+from service import FilmService, PlanetService, projection
+from validation import response_validator
+
+PAGE_SIZES = (10, 100, 1000)
+FILM_QUERY = {
+    "title": "Ma",
+    "director": "George",
+    "order_by": "-release_date",
+    "page": "3",
+    "page_size": "100",
+    "fields": "title,director,planets",
+}
+PLANET_QUERY = {
+    "name": "Tat",
+    "film": "Alo",
+    "resident": "Ka",
+    "order_by": "-population",
+    "page_size": "100",
+    "exclude": "residents,films",
+}
+
+
+@pytest.fixture(scope="module")
+def planet_pages(galaxy):
+    return {size: PlanetService.list(None, page_size=size) for size in PAGE_SIZES}
+
+
+def test_film_query_building(benchmark):
+    def build():
+        query = FilmService.filter_query("Ma", "George", "Alo")
+        return query, projection("release_date", ["title"], None)
+
+    benchmark(build)
+
+
+def test_planet_query_building(benchmark):
+    benchmark(PlanetService.filter_query, "Tat", "Alo", "Ka")
+
+
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_film_list(benchmark, galaxy, page_size):
+    benchmark(FilmService.list, page_size=page_size)
+
+
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_planet_list(benchmark, galaxy, page_size):
+    benchmark(PlanetService.list, None, page_size=page_size, order_by="-population")
+
+
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_stdlib_json_encoding(benchmark, planet_pages, page_size):
+    provider = MongoJsonProvider(app)
+    with app.app_context():
+        benchmark(provider.response, {"planets": planet_pages[page_size]})
+
+
+@pytest.mark.skipif(orjson is None, reason="orjson is not installed")
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_orjson_encoding(benchmark, planet_pages, page_size):
+    provider = OrjsonProvider(app)
+    with app.app_context():
+        benchmark(provider.response, {"planets": planet_pages[page_size]})
+
+
+def test_film_filter_parsing(benchmark):
+    benchmark(FilmFilter.parse_obj, FILM_QUERY)
+
+
+def test_planets_filter_parsing(benchmark):
+    benchmark(PlanetsFilter.parse_obj, PLANET_QUERY)
+
+
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_planet_parsing(benchmark, planet_pages, page_size):
+    docs = planet_pages[page_size]
+    benchmark(lambda: [Planet.parse_obj(doc) for doc in docs])
+
+
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_planets_response_validation(benchmark, planet_pages, page_size):
+    benchmark(PlanetsResponse.validate, {"planets": planet_pages[page_size]})
+
+
+@pytest.mark.parametrize("mode", ("off", "strict"))
+@pytest.mark.parametrize("page_size", PAGE_SIZES)
+def test_spec_validate_overhead(benchmark, galaxy, mode, page_size):
+    # Cached pages, so the difference between modes is spec.validate itself
+    client = app.test_client()
+    url = f"/planets?page_size={page_size}&order_by=-population"
+    client.get(url)
+    previous = response_validator.mode
+    response_validator.configure(mode)
+    try:
+        response = benchmark(client.get, url)
+    finally:
+        response_validator.configure(previous)
+    assert response.status_code == 200
@@ -0,0 +1,57 @@
+# Bytes on the wire and compression time of planet list pages per encoding.
+#
+#   cd flask_app && python -m benchmarks.compression
+import json
+import statistics
+import time
+
+from bson import ObjectId
+
+import compression
+from server import app
+
+PAGE_SIZES = (10, 100, 1000)
+ROUNDS = 20
+
+
+def page(size: int) -> bytes:
+    payload = {
+        "planets": [
+            {
+                "_id": ObjectId(),
+                "name": f"Planet {i}",
+                "climate": "temperate",
+                "terrain": "grasslands, mountains",
+                "population": "2000000000",
+                "residents": [f"Resident {i}-{j}" for j in range(20)],
+                "films": [f"Film {j}" for j in range(6)],
+                "last_updated": "2023-01-02 12:00:00",
+            }
+            for i in range(size)
+        ],
+        "next_cursor": None,
+    }
+    return app.json.dumps(payload, separators=(",", ":")).encode()
+
+
+def measure(body: bytes, encoding: str) -> dict:
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        data = compression.compress(body, encoding)
+        timings.append(time.perf_counter() - start)
+    return {
+        "bytes": len(data),
+        "ratio": round(len(body) / len(data), 2),
+        "compress_ms": round(statistics.median(timings) * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+    results = {}
+    for size in PAGE_SIZES:
+        body = page(size)
+        results[size] = {"identity": {"bytes": len(body)}}
+        for encoding in compression.ENCODINGS:
+            results[size][encoding] = measure(body, encoding)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,19 @@
+import pytest
+from mongomock import MongoClient
+
+from benchmarks.galaxy import generate_films, generate_planets
+from db import MongoDBConnection
+from service import FilmService, PlanetService
+
+PLANETS = 2000
+FILMS = 1000
+SEED = 42
+
+
+@pytest.fixture(scope="session")
+def galaxy():
+    MongoDBConnection.client = MongoClient()
+    PlanetService.bulk_save(enumerate(generate_planets(SEED, PLANETS, FILMS)))
+    FilmService.bulk_save(enumerate(generate_films(SEED, PLANETS, FILMS)))
+    yield
+    MongoDBConnection.client = None
@@ -0,0 +1,118 @@
+# Deterministic synthetic galaxy shaped like Film/Planet documents. The same
+# seed and sizes always produce the same documents, so runs before and after
+# a change load identical data.
+import random
+from typing import Iterator, List
+
+SYLLABLES = (
+    "al",
+    "an",
+    "ar",
+    "bes",
+    "bo",
+    "cor",
+    "da",
+    "dan",
+    "de",
+    "dro",
+    "en",
+    "er",
+    "ga",
+    "go",
+    "ho",
+    "il",
+    "ka",
+    "kash",
+    "lo",
+    "lu",
+    "ma",
+    "mus",
+    "na",
+    "nal",
+    "oo",
+    "or",
+    "pin",
+    "ra",
+    "rel",
+    "ro",
+    "sca",
+    "ta",
+    "tat",
+    "th",
+    "to",
+    "ul",
+    "ut",
+    "va",
+    "vin",
+    "wo",
+    "ya",
+    "zel",
+)
+CLIMATES = ("arid", "temperate", "tropical", "frozen", "murky", "windy", "hot")
+TERRAINS = ("desert", "grasslands", "mountains", "jungle", "tundra", "ocean")
+DIRECTORS = ("George Lucas", "Irvin Kershner", "Richard Marquand", "J. J. Abrams")
+PRODUCERS = ("Gary Kurtz", "Rick McCallum", "Howard G. Kazanjian", "Kathleen Kennedy")
+
+
+def word(rng: random.Random, syllables: int) -> str:
+    return "".join(rng.choice(SYLLABLES) for _ in range(syllables)).capitalize()
+
+
+def unique_name(rng: random.Random, index: int) -> str:
+    # The hex index keeps names unique however many are generated
+    return f"{word(rng, rng.randint(2, 3))} {index:x}"
+
+
+def residents_count(rng: random.Random) -> int:
+    # Most planets have a handful of known residents, a few have dozens
+    return min(int(rng.paretovariate(1.2)) - 1, 60)
+
+
+def film_titles(seed: int, films: int) -> List[str]:
+    rng = random.Random(f"{seed}:films")
+    return [f"{word(rng, 2)} {word(rng, 3)} {i}" for i in range(films)]
+
+
+def planet_names(seed: int, planets: int) -> Iterator[str]:
+    rng = random.Random(f"{seed}:planets")
+    for i in range(planets):
+        yield unique_name(rng, i)
+
+
+def generate_planets(seed: int, planets: int, films: int) -> Iterator[dict]:
+    rng = random.Random(f"{seed}:planet-docs")
+    titles = film_titles(seed, films)
+    for i, name in enumerate(planet_names(seed, planets)):
+        yield {
+            "name": name,
+            "rotation_period": str(rng.randint(10, 60)),
+            "orbital_period": str(rng.randint(100, 5000)),
+            "diameter": str(rng.randint(0, 200000)),
+            "climate": rng.choice(CLIMATES),
+            "gravity": f"{rng.randint(1, 3)} standard",
+            "terrain": ", ".join(rng.sample(TERRAINS, rng.randint(1, 3))),
+            "surface_water": str(rng.randint(0, 100)),
+            "population": str(rng.randint(0, 10**12)),
+            "residents": [
+                f"{word(rng, 2)} {word(rng, 3)}" for _ in range(residents_count(rng))
+            ],
+            "films": rng.sample(titles, min(len(titles), rng.randint(1, 6))),
+        }
+
+
+def generate_films(seed: int, planets: int, films: int) -> Iterator[dict]:
+    rng = random.Random(f"{seed}:film-docs")
+    names = None
+    for episode_id, title in enumerate(film_titles(seed, films), start=1):
+        if names is None:
+            # Films reference planets from the first 100k so generating
+            # them never needs every planet name in memory at once.
+            names = list(planet_names(seed, min(planets, 100000)))
+        yield {
+            "title": title,
+            "episode_id": episode_id,
+            "director": rng.choice(DIRECTORS),
+            "producer": rng.sample(PRODUCERS, rng.randint(1, 2)),
+            "release_date": f"{rng.randint(1977, 2019)}-{rng.randint(1, 12):02d}-01",
+            "planets": rng.sample(names, min(len(names), rng.randint(1, 15))),
+        }
@@ -0,0 +1,57 @@
+# Encoding time of list pages with the stdlib and orjson JSON providers.
+#
+#   cd flask_app && python -m benchmarks.json_provider
+import json
+import statistics
+import time
+from datetime import datetime
+
+from bson import ObjectId
+
+from json_provider import MongoJsonProvider, OrjsonProvider
+from server import app
+
+PAGE_SIZES = (1000, 10000)
+ROUNDS = 10
+
+
+def page(size: int) -> dict:
+    return {
+        "planets": [
+            {
+                "_id": ObjectId(),
+                "name": f"Planet {i}",
+                "climate": "temperate",
+                "terrain": "grasslands, mountains",
+                "population": "2000000000",
+                "residents": [f"Resident {i}-{j}" for j in range(20)],
+                "films": [f"Film {j}" for j in range(6)],
+                "last_updated": datetime(2023, 1, 2, 12, 0, 0),
+            }
+            for i in range(size)
+        ],
+        "next_cursor": None,
+    }
+
+
+def measure(provider, payload: dict) -> float:
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        provider.response(payload)
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+if __name__ == "__main__":
+    results = {}
+    for size in PAGE_SIZES:
+        payload = page(size)
+        stdlib_ms = measure(MongoJsonProvider(app), payload)
+        orjson_ms = measure(OrjsonProvider(app), payload)
+        results[size] = {
+            "stdlib_ms": stdlib_ms,
+            "orjson_ms": orjson_ms,
+            "speedup": round(stdlib_ms / orjson_ms, 2),
+        }
+    print(json.dumps(results, indent=2))
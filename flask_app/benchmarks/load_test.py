@@ -0,0 +1,186 @@
+# End-to-end load test: seeds a synthetic galaxy, then drives the real routes
+# in server.py with concurrent clients and a mix of list, filter, sort,
+# deep-page, lookup and write calls. Prints latency percentiles and
+# requests per second as JSON.
+#
+#   cd flask_app && python -m benchmarks.load_test --planets 10000
+#   # against a local mongod (MONGODB_* variables as for the app)
+#   MONGODB_HOST=localhost python -m benchmarks.load_test --mongo real
+#
+# Runs in-process through the Flask test client, so nothing but mongomock
+# (or a mongod) is needed. Set CACHE_MAX_ENTRIES=0 to measure without the
+# response cache.
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from itertools import islice
+
+from mongomock import MongoClient
+
+from benchmarks.galaxy import film_titles, generate_films, generate_planets
+from db import MongoDBConnection
+from server import app
+from service import FilmService, PlanetService
+
+SEED_BATCH_SIZE = 1000
+# Relative weight of each kind of call in the mix
+MIX = {
+    "list": 30,
+    "filter": 20,
+    "sort": 15,
+    "deep_page": 10,
+    "get": 10,
+    "write": 15,
+}
+# A write first reads the planet it modifies; that GET is reported on its
+# own, so "write" times the PUT alone.
+KINDS = (*MIX, "write_read")
+SORTS = ("name", "-name", "diameter", "-population", "rotation_period")
+
+
+def seed(args):
+    MongoDBConnection.films().drop()
+    MongoDBConnection.planets().drop()
+    MongoDBConnection.ensure_indexes()
+    planets = generate_planets(args.seed, args.planets, args.films)
+    while batch := list(islice(planets, SEED_BATCH_SIZE)):
+        PlanetService.bulk_save(enumerate(batch))
+    FilmService.bulk_save(
+        enumerate(generate_films(args.seed, args.planets, args.films))
+    )
+
+
+class Client(threading.Thread):
+    def __init__(self, index: int, args, deadline: float):
+        super().__init__()
+        self.rng = random.Random(f"{args.seed}:client:{index}")
+        self.args = args
+        self.deadline = deadline
+        self.http = app.test_client()
+        self.titles = film_titles(args.seed, args.films)
+        self.ids = []
+        self.timings = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def timed(self, kind: str, call):
+        start = time.perf_counter()
+        response = call()
+        self.timings[kind].append(time.perf_counter() - start)
+        if response.status_code >= 400:
+            self.errors[kind] += 1
+        return response
+
+    def write(self):
+        planet_id = self.rng.choice(self.ids)
+        planet = self.timed(
+            "write_read", lambda: self.http.get(f"/planets/{planet_id}")
+        ).get_json()
+        planet = {k: v for k, v in planet.items() if k not in ("_id", "_search")}
+        planet["population"] = str(self.rng.randint(0, 10**12))
+        self.timed("write", lambda: self.http.put(f"/planets/{planet_id}", json=planet))
+
+    def request(self, kind: str):
+        page_size = self.args.page_size
+        if kind == "list":
+            return self.http.get(f"/planets?page_size={page_size}")
+        if kind == "filter":
+            if self.rng.random() < 0.5:
+                film = self.rng.choice(self.titles).split(" ")[0]
+                return self.http.get(f"/planets?film={film}&page_size={page_size}")
+            return self.http.get(f"/films?title={self.rng.choice(self.titles)}")
+        if kind == "sort":
+            order_by = self.rng.choice(SORTS)
+            return self.http.get(f"/planets?order_by={order_by}&page_size={page_size}")
+        if kind == "deep_page":
+            page = self.rng.randint(1, max(1, self.args.planets // page_size))
+            return self.http.get(
+                f"/planets?page={page}&page_size={page_size}&include_total=false"
+            )
+        if kind == "get" and self.ids:
+            return self.http.get(f"/planets/{self.rng.choice(self.ids)}")
+        return self.http.get(f"/planets?page_size={page_size}")
+
+    def run(self):
+        data = self.http.get("/planets?page_size=100&fields=name").get_json()
+        self.ids = [planet["_id"] for planet in data["planets"]]
+        kinds = list(MIX)
+        weights = list(MIX.values())
+        while time.perf_counter() < self.deadline:
+            kind = self.rng.choices(kinds, weights)[0]
+            if kind == "write" and self.ids:
+                self.write()
+            else:
+                self.timed(kind, lambda: self.request(kind))
+
+
+def summary(timings: list, errors: int, elapsed: float) -> dict:
+    timings = sorted(timings)
+
+    def percentile(p: float) -> float:
+        if not timings:
+            return None
+        return round(timings[max(0, int(len(timings) * p) - 1)] * 1000, 3)
+
+    return {
+        "requests": len(timings),
+        "errors": errors,
+        "rps": round(len(timings) / elapsed, 1),
+        "p50_ms": percentile(0.50),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--planets", type=int, default=1000)
+    parser.add_argument("--films", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--page-size", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--mongo", choices=("mock", "real"), default="mock")
+    parser.add_argument("--skip-seed", action="store_true")
+    args = parser.parse_args()
+
+    if args.mongo == "mock":
+        MongoDBConnection.client = MongoClient()
+    seed_start = time.perf_counter()
+    if not args.skip_seed:
+        seed(args)
+    seed_seconds = time.perf_counter() - seed_start
+
+    start = time.perf_counter()
+    clients = [Client(i, args, start + args.duration) for i in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+
+    by_kind = {
+        kind: summary(
+            [t for c in clients for t in c.timings[kind]],
+            sum(c.errors[kind] for c in clients),
+            elapsed,
+        )
+        for kind in KINDS
+    }
+    result = {
+        "config": {**vars(args), "mix": MIX},
+        "seed_seconds": round(seed_seconds, 2),
+        "total": summary(
+            [t for c in clients for ts in c.timings.values() for t in ts],
+            sum(sum(c.errors.values()) for c in clients),
+            elapsed,
+        ),
+        "by_kind": by_kind,
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
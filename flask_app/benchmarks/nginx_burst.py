@@ -0,0 +1,72 @@
+# Burst of identical list requests through the nginx micro-cache, against the
+# compose stack. Upstream requests are counted with the app's own cache
+# stats, which see every list request that gets past nginx.
+#
+#   docker compose up -d
+#   cd flask_app && python -m benchmarks.nginx_burst
+import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+
+NGINX_URL = os.getenv("NGINX_URL", "http://localhost")
+REQUESTS = int(os.getenv("BURST_REQUESTS", 500))
+CONCURRENCY = int(os.getenv("BURST_CONCURRENCY", 32))
+LIST_PATH = "/films?page_size=5&order_by=-episode_id"
+
+
+def call(path: str, body: dict = None):
+    data = json.dumps(body).encode() if body is not None else None
+    request = Request(
+        NGINX_URL + path,
+        data=data,
+        headers={"Content-Type": "application/json"},
+        method="POST" if body is not None else "GET",
+    )
+    with urlopen(request, timeout=10) as response:
+        return response.headers, json.loads(response.read() or b"null")
+
+
+def upstream_requests() -> int:
+    _, stats = call("/cache/stats")
+    return stats["hits"] + stats["misses"]
+
+
+def create_film(episode_id: int):
+    call(
+        "/films",
+        {
+            "title": f"Burst {episode_id}",
+            "episode_id": episode_id,
+            "director": "George Lucas",
+            "producer": ["Rick McCallum"],
+            "release_date": "1999-05-19",
+            "planets": ["Naboo"],
+        },
+    )
+
+
+if __name__ == "__main__":
+    create_film(1000)
+    before = upstream_requests()
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        headers = list(pool.map(lambda _: call(LIST_PATH)[0], range(REQUESTS)))
+    upstream = upstream_requests() - before
+
+    # Write-after-read: the write bumps the nginx version, so the very next
+    # read is a miss that already sees the new film.
+    _, page = call(LIST_PATH)
+    create_film(page["films"][0]["episode_id"] + 1)
+    _, fresh = call(LIST_PATH)
+
+    result = {
+        "requests": REQUESTS,
+        "upstream_requests": upstream,
+        "cache_status": Counter(h.get("X-Cache-Status", "-") for h in headers),
+        "fresh_after_write": fresh["total"] == page["total"] + 1,
+    }
+    print(json.dumps(result, indent=2))
+    if upstream * 2 > REQUESTS or not result["fresh_after_write"]:
+        sys.exit(1)
@@ -0,0 +1,57 @@
+# Per-request time of cached list pages with each response validation mode.
+#
+#   cd flask_app && python -m benchmarks.response_validation
+import json
+import statistics
+import time
+
+from mongomock import MongoClient
+
+from db import MongoDBConnection
+from server import app
+from service import FilmService
+from validation import RESPONSE_VALIDATION_MODES, response_validator
+
+PAGE_SIZES = (100, 1000)
+DOCUMENTS = 1000
+ROUNDS = 50
+
+
+def seed():
+    MongoDBConnection.client = MongoClient()
+    for i in range(DOCUMENTS):
+        FilmService.create(
+            {
+                "title": f"Film {i}",
+                "episode_id": i,
+                "director": "George Lucas",
+                "producer": ["Gary Kurtz", "Rick McCallum"],
+                "release_date": "1977-05-25",
+                "planets": [f"Planet {j}" for j in range(10)],
+            }
+        )
+
+
+def measure(client, url: str) -> float:
+    # The response cache is warm after the first request, so the remaining
+    # time is mostly routing, query validation and response validation.
+    assert client.get(url).status_code == 200, url
+    timings = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        client.get(url)
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 3)
+
+
+if __name__ == "__main__":
+    seed()
+    client = app.test_client()
+    results = {}
+    for page_size in PAGE_SIZES:
+        url = f"/films?page_size={page_size}"
+        results[page_size] = {}
+        for mode in RESPONSE_VALIDATION_MODES:
+            response_validator.configure(mode, 0.01)
+            results[page_size][f"{mode}_ms"] = measure(client, url)
+    print(json.dumps(results, indent=2))
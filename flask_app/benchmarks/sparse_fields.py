@@ -0,0 +1,64 @@
+# Payload size and serialization time of full vs sparse planet pages.
+#
+#   cd flask_app && python -m benchmarks.sparse_fields
+import json
+import statistics
+import time
+
+from mongomock import MongoClient
+
+from db import MongoDBConnection
+from server import app
+from service import PlanetService
+
+PAGE_SIZE = 1000
+ROUNDS = 20
+
+
+def seed():
+    MongoDBConnection.client = MongoClient()
+    for i in range(PAGE_SIZE):
+        PlanetService.create(
+            {
+                "name": f"Planet {i}",
+                "rotation_period": "24",
+                "orbital_period": "364",
+                "diameter": "12500",
+                "climate": "temperate",
+                "gravity": "1 standard",
+                "terrain": "grasslands, mountains",
+                "surface_water": "40",
+                "population": "2000000000",
+                "residents": [f"Resident {i}-{j}" for j in range(50)],
+                "films": [f"Film {j}" for j in range(6)],
+            }
+        )
+
+
+def measure(params: dict) -> dict:
+    docs = PlanetService.list(name=None, page_size=PAGE_SIZE, **params)
+    timings = []
+    with app.app_context():
+        for _ in range(ROUNDS):
+            start = time.perf_counter()
+            body = app.json.dumps({"planets": docs})
+            timings.append(time.perf_counter() - start)
+    return {
+        "bytes": len(body.encode()),
+        "serialize_ms": round(statistics.median(timings) * 1000, 3),
+    }
+
+
+if __name__ == "__main__":
+    seed()
+    print(
+        json.dumps(
+            {
+                "page_size": PAGE_SIZE,
+                "full": measure({}),
+                "fields=name,climate": measure({"fields": ["name", "climate"]}),
+                "exclude=residents": measure({"exclude": ["residents"]}),
+            },
+            indent=2,
+        )
+    )
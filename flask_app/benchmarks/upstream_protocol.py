@@ -0,0 +1,53 @@
+# Throughput and tail latency through nginx for the current upstream setup.
+# Run it once per stack and compare:
+#
+#   docker compose up -d --build
+#   cd flask_app && python -m benchmarks.upstream_protocol http
+#   docker compose -f docker-compose.yml -f docker-compose.uwsgi.yml up -d --build
+#   cd flask_app && python -m benchmarks.upstream_protocol uwsgi
+#
+# /cache/stats is never cached by nginx and does no Mongo work, so the numbers
+# are dominated by the nginx -> uWSGI hop.
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+
+NGINX_URL = os.getenv("NGINX_URL", "http://localhost")
+REQUESTS = int(os.getenv("BENCH_REQUESTS", 5000))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", 32))
+PATH = "/cache/stats"
+
+
+def timed_request(_) -> float:
+    start = time.perf_counter()
+    with urlopen(NGINX_URL + PATH, timeout=10) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def percentile(timings: list, p: float) -> float:
+    return round(timings[int(len(timings) * p) - 1] * 1000, 3)
+
+
+if __name__ == "__main__":
+    label = sys.argv[1] if len(sys.argv) > 1 else "current"
+    with ThreadPoolExecutor(CONCURRENCY) as pool:
+        list(pool.map(timed_request, range(CONCURRENCY * 4)))
+        start = time.perf_counter()
+        timings = sorted(pool.map(timed_request, range(REQUESTS)))
+        elapsed = time.perf_counter() - start
+    result = {
+        "upstream": label,
+        "requests": REQUESTS,
+        "concurrency": CONCURRENCY,
+        "rps": round(REQUESTS / elapsed, 1),
+        "p50_ms": percentile(timings, 0.50),
+        "p95_ms": percentile(timings, 0.95),
+        "p99_ms": percentile(timings, 0.99),
+        "mean_ms": round(statistics.mean(timings) * 1000, 3),
+    }
+    print(json.dumps(result, indent=2))
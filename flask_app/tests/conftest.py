@@ -1,14 +1,19 @@
 import pytest
 from mongomock import MongoClient
 
+import admin
 from server import app as flask_app
+from cache import response_cache
 from db import MongoDBConnection
 
 
 # Configuração do banco de dados mock
 @pytest.fixture(scope="function")
-def mongo_mock():
+def mongo_mock(monkeypatch):
     MongoDBConnection.client = MongoClient()
+    response_cache.clear()
+    # A single mongomock "node": nothing ever lags behind a write
+    monkeypatch.setattr(response_cache, "settle_seconds", 0)
     yield
     MongoDBConnection.client = None
 
@@ -26,3 +31,9 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture
+def admin_headers(monkeypatch):
+    monkeypatch.setattr(admin, "ADMIN_TOKEN", "secret")
+    return {"Authorization": "Bearer secret"}
@@ -0,0 +1,247 @@
+from bson import ObjectId
+from cache import (
+    CACHE_MAX_ENTRIES,
+    EdgeCache,
+    MemoryBackend,
+    ResponseCache,
+    UWSGIBackend,
+    response_cache,
+)
+import server
+from models import FilmFilter
+
+
+class FakeUwsgi:
+    # Local stand-in for the uWSGI cache API, shared like the real host cache
+    def __init__(self):
+        self.caches = {"responses": {}, "counters": {}}
+
+    def cache_get(self, key, cache):
+        return self.caches[cache].get(key)
+
+    def cache_set(self, key, value, expires, cache):
+        if key in self.caches[cache]:
+            return None
+        self.caches[cache][key] = value
+        return True
+
+    def cache_update(self, key, value, expires, cache):
+        self.caches[cache][key] = value
+        return True
+
+    def cache_inc(self, key, amount, expires, cache):
+        self.caches[cache][key] = self.caches[cache].get(key, 0) + amount
+        return True
+
+    def cache_num(self, key, cache):
+        return self.caches[cache].get(key)
+
+    def cache_clear(self, cache):
+        self.caches[cache].clear()
+
+
+def test_cache_lru_eviction():
+    cache = ResponseCache(MemoryBackend(max_entries=2, ttl=60))
+    cache.set("a", b"1")
+    cache.set("b", b"2")
+    assert cache.get("a") == b"1"
+    cache.set("c", b"3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["hits"] == 3
+    assert cache.stats()["misses"] == 1
+
+
+def test_cache_ttl_expiration():
+    cache = ResponseCache(MemoryBackend(max_entries=2, ttl=-1))
+    cache.set("a", b"1")
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_cache_key_normalized_and_versioned():
+    cache = ResponseCache(MemoryBackend())
+    key = cache.key("films", FilmFilter())
+    assert key == cache.key("films", FilmFilter(page=1, order_by="episode_id"))
+    assert key != cache.key("films", FilmFilter(page=2))
+
+    cache.bump("films")
+    assert key != cache.key("films", FilmFilter())
+    assert cache.key("planets", FilmFilter()).startswith(
+        f"planets:{cache.backend.epoch()}.0:"
+    )
+
+
+def test_cache_clear_changes_version():
+    cache = ResponseCache(MemoryBackend())
+    version = cache.version("films")
+    cache.clear()
+    assert cache.version("films") != version
+
+
+def test_uwsgi_backend_shared_between_workers():
+    uwsgi = FakeUwsgi()
+    worker_one = ResponseCache(UWSGIBackend(uwsgi))
+    worker_two = ResponseCache(UWSGIBackend(uwsgi))
+
+    key = worker_one.key("films", FilmFilter())
+    worker_one.set(key, b"{}")
+    assert worker_two.get(worker_two.key("films", FilmFilter())) == b"{}"
+
+    worker_two.bump("films")
+    assert worker_one.get(worker_one.key("films", FilmFilter())) is None
+    assert worker_one.stats()["hits"] == 1
+    assert worker_one.stats()["misses"] == 1
+    assert worker_one.stats()["backend"] == "uwsgi"
+    assert worker_one.stats()["max_entries"] == CACHE_MAX_ENTRIES
+    assert worker_one.version("films") == worker_two.version("films")
+
+
+def test_list_films_cached_until_write(client, mongo_mock, admin_headers):
+    film_data = {
+        "title": "A New Hope",
+        "episode_id": 4,
+        "director": "George Lucas",
+        "producer": ["Gary Kurtz", "Rick McCallum"],
+        "release_date": "1977-05-25",
+        "planets": ["Tatooine", "Alderaan"],
+    }
+    assert client.get("/films").get_json()["films"] == []
+    assert client.get("/films").get_json()["films"] == []
+    assert response_cache.stats()["hits"] == 1
+
+    client.post("/films", json=film_data)
+    # Read as another client, not pinned to the primary by the write
+    client.delete_cookie("read_primary_until")
+    assert len(client.get("/films").get_json()["films"]) == 1
+
+    response = client.get("/cache/stats", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.get_json()["misses"] == 2
+
+
+def test_client_reads_from_primary_after_writing(client, mongo_mock, monkeypatch):
+    monkeypatch.setattr(server, "READ_YOUR_WRITES_SECONDS", 5)
+    client.get("/films")
+    response = client.post(
+        "/films",
+        json={
+            "title": "A New Hope",
+            "episode_id": 4,
+            "director": "George Lucas",
+            "producer": ["Gary Kurtz"],
+            "release_date": "1977-05-25",
+            "planets": ["Tatooine"],
+        },
+    )
+    assert "read_primary_until=" in response.headers["Set-Cookie"]
+
+    etag = client.get("/films").headers["ETag"].strip('"')
+    response = client.get("/films", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response_cache.stats()["hits"] == 0
+
+
+def test_forged_read_primary_cookie_ignored(client, mongo_mock):
+    client.get("/films")
+    for forged in ("9999999999", "9999999999:0123456789abcdef"):
+        client.set_cookie("read_primary_until", forged)
+        assert "ETag" in client.get("/films").headers
+    assert response_cache.stats()["hits"] == 2
+
+
+def test_secondary_reads_not_cached_until_settled(client, mongo_mock, monkeypatch):
+    monkeypatch.setattr(response_cache, "settle_seconds", 60)
+    film_data = {
+        "title": "A New Hope",
+        "episode_id": 4,
+        "director": "George Lucas",
+        "producer": ["Gary Kurtz"],
+        "release_date": "1977-05-25",
+        "planets": ["Tatooine"],
+    }
+    film_id = client.post("/films", json=film_data).get_json()["film_id"]
+
+    # The writer is pinned to the primary, so its reads are safe to keep
+    response = client.get("/films")
+    assert "ETag" in response.headers
+    assert "X-Accel-Expires" not in response.headers
+
+    client.delete_cookie("read_primary_until")
+    response_cache.clear()
+    for url in ("/films?page_size=5", f"/films/{film_id}", f"/films?ids={film_id}"):
+        response = client.get(url)
+        assert response.status_code == 200
+        assert "ETag" not in response.headers
+        assert response.headers["X-Accel-Expires"] == "0"
+    client.get("/films?page_size=5")
+    assert response_cache.stats()["hits"] == 0
+
+    monkeypatch.setattr(response_cache, "settle_seconds", 0)
+    response = client.get("/films?page_size=5")
+    assert "ETag" in response.headers
+    assert "X-Accel-Expires" not in response.headers
+    client.get("/films?page_size=5")
+    assert response_cache.stats()["hits"] == 1
+
+
+def test_document_cache_bumped():
+    cache = ResponseCache(MemoryBackend())
+    doc = {"_id": ObjectId(), "name": "Tatooine"}
+    cache.set_document("planets", doc)
+    assert cache.get_document("planets", doc["_id"]) == doc
+
+    cache.bump_documents("planets")
+    assert cache.get_document("planets", doc["_id"]) is None
+
+    # A read that started before the write is stored under the old version
+    version = cache.documents_version("planets")
+    cache.bump_documents("planets")
+    cache.set_document("planets", doc, version)
+    assert cache.get_document("planets", doc["_id"]) is None
+
+
+def test_bump_notifies_nginx(monkeypatch):
+    requests = []
+
+    class Reply:
+        def close(self):
+            pass
+
+    def fake_urlopen(request, timeout):
+        requests.append((request.method, request.full_url))
+        if "planets" in request.full_url:
+            raise OSError("connection refused")
+        return Reply()
+
+    monkeypatch.setattr("cache.urlopen", fake_urlopen)
+    response = ResponseCache(MemoryBackend(), EdgeCache("http://nginx:8080/cache/bump"))
+    response.bump("films")
+    response.bump("planets")
+    response.bump_documents("films")
+
+    assert requests == [
+        ("POST", "http://nginx:8080/cache/bump?collection=films"),
+        ("POST", "http://nginx:8080/cache/bump?collection=planets"),
+    ]
+    assert response.generation("planets") == 1
+
+
+def test_backfill_invalidates_cached_lists(client, mongo_mock):
+    server.MongoDBConnection.films().insert_one(
+        {
+            "title": "A New Hope",
+            "episode_id": 4,
+            "director": "George Lucas",
+            "producer": ["Gary Kurtz"],
+            "release_date": "1977-05-25",
+            "planets": [],
+        }
+    )
+    assert client.get("/films?title=hope").get_json()["films"] == []
+
+    server.FilmService.backfill_search()
+    assert len(client.get("/films?title=hope").get_json()["films"]) == 1
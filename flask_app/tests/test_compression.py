@@ -0,0 +1,70 @@
+import gzip
+
+import pytest
+
+import server
+from compression import compress
+from db import MongoDBConnection
+
+
+def insert_planets(count: int):
+    MongoDBConnection.planets().insert_many(
+        [
+            {
+                "name": f"Planet {i}",
+                "climate": "temperate",
+                "residents": [f"Resident {i}-{j}" for j in range(20)],
+                "films": ["A New Hope"],
+                "last_updated": "2023-01-02 12:00:00",
+            }
+            for i in range(count)
+        ]
+    )
+
+
+def test_list_compressed_when_accepted(client, mongo_mock):
+    insert_planets(10)
+    plain = client.get("/planets")
+    assert "Content-Encoding" not in plain.headers
+
+    response = client.get("/planets", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(response.data) == plain.data
+    assert response.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+    etag = response.headers["ETag"].strip('"')
+    response = client.get(
+        "/planets", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status_code == 304
+
+
+def test_small_responses_not_compressed(client, mongo_mock):
+    insert_planets(1)
+    response = client.get("/planets?fields=name", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_compressed_body_cached(client, mongo_mock, monkeypatch):
+    insert_planets(10)
+    calls = []
+
+    def counted(data, encoding):
+        calls.append(encoding)
+        return compress(data, encoding)
+
+    monkeypatch.setattr(server, "compress", counted)
+    first = client.get("/planets", headers={"Accept-Encoding": "gzip"})
+    second = client.get("/planets", headers={"Accept-Encoding": "gzip"})
+    assert second.data == first.data
+    assert calls == ["gzip"]
+
+
+def test_brotli_preferred(client, mongo_mock):
+    brotli = pytest.importorskip("brotli")
+    insert_planets(10)
+    plain = client.get("/planets")
+    response = client.get("/planets", headers={"Accept-Encoding": "gzip, br"})
+    assert response.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(response.data) == plain.data
@@ -0,0 +1,101 @@
+import pytest
+from pymongo.read_preferences import Primary, SecondaryPreferred
+
+import db
+from db import MongoDBConnection, PoolStats, client_options, read_primary
+
+
+class FakeMongoClient:
+    def __init__(self, **options):
+        self.options = options
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    monkeypatch.setattr(db, "MongoClient", FakeMongoClient)
+    MongoDBConnection.reset()
+    yield
+    MongoDBConnection.reset()
+
+
+def test_client_options_from_environment(monkeypatch):
+    monkeypatch.setattr(db, "MONGODB_MAX_POOL_SIZE", 20)
+    monkeypatch.setattr(db, "MONGODB_MAX_IDLE_TIME_MS", "60000")
+    monkeypatch.setattr(db, "MONGODB_WAIT_QUEUE_TIMEOUT_MS", "500")
+    monkeypatch.setattr(db, "MONGODB_COMPRESSORS", "zlib")
+
+    options = client_options()
+
+    assert options["maxPoolSize"] == 20
+    assert options["maxIdleTimeMS"] == 60000
+    assert options["waitQueueTimeoutMS"] == 500
+    assert options["compressors"] == "zlib"
+    assert db.pool_stats in options["event_listeners"]
+
+
+def test_client_rebuilt_after_fork(fake_client, monkeypatch):
+    client = MongoDBConnection.get_client()
+    assert MongoDBConnection.get_client() is client
+
+    monkeypatch.setattr(db.os, "getpid", lambda: -1)
+    forked = MongoDBConnection.get_client()
+    assert forked is not client
+    assert MongoDBConnection.get_client() is forked
+
+
+def test_on_fork_drops_inherited_client(fake_client, monkeypatch):
+    monkeypatch.setattr(db, "MONGODB_WARM_UP", False)
+    client = MongoDBConnection.get_client()
+    MongoDBConnection.on_fork()
+    assert MongoDBConnection.client is None
+    assert MongoDBConnection.get_client() is not client
+
+
+def test_pool_stats():
+    stats = PoolStats()
+    stats.connection_created(None)
+    stats.connection_created(None)
+    stats.connection_check_out_started(None)
+    stats.connection_check_out_started(None)
+    stats.connection_checked_out(None)
+    assert stats.snapshot()["waiting"] == 1
+    assert stats.snapshot()["checked_out"] == 1
+
+    stats.connection_check_out_failed(None)
+    stats.connection_checked_in(None)
+    stats.connection_closed(None)
+
+    snapshot = stats.snapshot()
+    assert snapshot["open"] == 1
+    assert snapshot["created"] == 2
+    assert snapshot["closed"] == 1
+    assert snapshot["waiting"] == 0
+    assert snapshot["checked_out"] == 0
+    assert snapshot["checkout_failed"] == 1
+
+
+def test_db_pool_endpoint(client, mongo_mock, admin_headers):
+    response = client.get("/db/pool", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.get_json()["max_pool_size"] == db.MONGODB_MAX_POOL_SIZE
+
+
+def test_reads_go_to_secondaries_and_writes_to_primary(mongo_mock, monkeypatch):
+    monkeypatch.setattr(db, "MONGODB_WRITE_CONCERN", "2")
+    monkeypatch.setattr(db, "MONGODB_WRITE_CONCERN_TIMEOUT_MS", "5000")
+
+    reads = MongoDBConnection.films("read")
+    writes = MongoDBConnection.films()
+
+    assert reads.read_preference == SecondaryPreferred(max_staleness=90)
+    assert reads.read_concern.level == "local"
+    assert writes.read_preference == Primary()
+    assert writes.write_concern.document == {"w": 2, "wtimeout": 5000}
+
+
+def test_pinned_reads_go_to_primary(mongo_mock):
+    token = read_primary.set(True)
+    try:
+        assert MongoDBConnection.planets("read").read_preference == Primary()
+    finally:
+        read_primary.reset(token)
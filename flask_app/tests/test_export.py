@@ -0,0 +1,40 @@
+import csv
+import io
+import itertools
+import json
+
+from bson import ObjectId
+
+from export import EXPORT_CHUNK_BYTES, csv_chunks, ndjson_chunks
+from server import app as flask_app
+
+
+def test_ndjson_chunks_are_bounded_and_lazy():
+    consumed = []
+
+    def docs():
+        for i in itertools.count():
+            consumed.append(i)
+            yield {"_id": ObjectId(), "name": f"Planet {i}"}
+
+    chunks = ndjson_chunks(docs(), flask_app.json.dumps)
+    first = next(chunks)
+    second = next(chunks)
+
+    assert EXPORT_CHUNK_BYTES <= len(first) < EXPORT_CHUNK_BYTES + 100
+    assert EXPORT_CHUNK_BYTES <= len(second) < EXPORT_CHUNK_BYTES + 100
+    assert len(consumed) < 2 * EXPORT_CHUNK_BYTES // 40
+    assert json.loads(first.splitlines()[0])["name"] == "Planet 0"
+
+
+def test_csv_chunks():
+    planet_id = ObjectId()
+    docs = [{"_id": planet_id, "name": "Hoth", "films": ["The Empire Strikes Back"]}]
+
+    body = "".join(csv_chunks(docs, ["_id", "name", "films"], flask_app.json.dumps))
+
+    rows = list(csv.reader(io.StringIO(body)))
+    assert rows == [
+        ["_id", "name", "films"],
+        [str(planet_id), "Hoth", '["The Empire Strikes Back"]'],
+    ]
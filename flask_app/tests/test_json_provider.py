@@ -0,0 +1,88 @@
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+
+import json_provider
+from json_provider import MongoJsonProvider, OrjsonProvider, build_json_provider
+
+PAYLOADS = [
+    {
+        "films": [
+            {
+                "_id": ObjectId(),
+                "title": "Star Wars: Episode I – The Phantom Menace",
+                "episode_id": 1,
+                "producer": ["Rick McCallum"],
+                "planets": ["Naboo", "Tatooine"],
+                "created": datetime(1999, 5, 19, 12, 30, 0),
+            }
+        ],
+        "next_cursor": None,
+    },
+    {
+        "planets": [
+            {
+                "_id": ObjectId(),
+                "name": "Naboo",
+                "residents": ["Padmé Amidala", "Ric Olié", "Gungan 🐸"],
+                "films": [],
+                "population": "4500000000",
+                "notes": 'quote " backslash \\ tab \t newline \n nul \x00 del \x7f',
+            }
+        ],
+        "next_cursor": "eyJhIjogMX0=",
+    },
+    {"nested": {"b": [1, 2.5, True, False, None], "a": {}}, "empty": []},
+    {"big": 2**70},
+    [],
+    "plain",
+]
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+@pytest.mark.parametrize("debug", [False, True])
+def test_orjson_provider_matches_current_output(app, payload, debug):
+    app.debug = debug
+    try:
+        expected = MongoJsonProvider(app).response(payload).get_data()
+        assert OrjsonProvider(app).response(payload).get_data() == expected
+    finally:
+        app.debug = False
+
+
+@pytest.mark.parametrize(
+    "value, current, fast",
+    [
+        (1e16, "1e+16", "1e16"),
+        (1e-7, "1e-07", "1e-7"),
+        (float("nan"), "NaN", "null"),
+        (float("inf"), "Infinity", "null"),
+        (-float("inf"), "-Infinity", "null"),
+    ],
+)
+def test_orjson_provider_float_differences(app, value, current, fast):
+    payload = {"value": value}
+    compact = {"separators": (",", ":")}
+    assert MongoJsonProvider(app).dumps(payload, **compact) == f'{{"value":{current}}}'
+    assert OrjsonProvider(app).dumps(payload, **compact) == f'{{"value":{fast}}}'
+    data = OrjsonProvider(app).response(payload).get_data()
+    assert data == f'{{"value":{fast}}}\n'.encode()
+
+
+@pytest.mark.parametrize("payload", PAYLOADS)
+def test_orjson_provider_dumps_matches_current_output(app, payload):
+    current = MongoJsonProvider(app)
+    fast = OrjsonProvider(app)
+    assert fast.dumps(payload) == current.dumps(payload)
+    assert fast.dumps(payload, separators=(",", ":")) == current.dumps(
+        payload, separators=(",", ":")
+    )
+
+
+def test_build_json_provider_falls_back_without_orjson(app, monkeypatch):
+    monkeypatch.setattr(json_provider, "orjson", None)
+    assert type(build_json_provider(app)) is MongoJsonProvider
+    assert type(build_json_provider(app, "stdlib")) is MongoJsonProvider
+    with pytest.raises(ImportError):
+        build_json_provider(app, "orjson")
@@ -0,0 +1,97 @@
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+from prometheus_client import REGISTRY
+
+from db import CommandMetrics, client_options, command_metrics
+
+APP_DIR = Path(__file__).resolve().parents[1] / "app"
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def command_event(command_name: str, command: dict, request_id: int, **extra):
+    return SimpleNamespace(
+        command_name=command_name,
+        command=command,
+        connection_id=("localhost", 27017),
+        request_id=request_id,
+        operation_id=request_id,
+        duration_micros=2500,
+        **extra,
+    )
+
+
+def test_request_metrics_by_route(client, mongo_mock):
+    labels = {"method": "GET", "route": "/films/<film_id>"}
+    before = sample("http_request_duration_seconds_count", **labels)
+    not_found = sample("http_requests_total", status="404", **labels)
+
+    client.get("/films/0123456789abcdef01234567")
+    client.get("/films/fedcba9876543210fedcba98")
+
+    assert sample("http_request_duration_seconds_count", **labels) == before + 2
+    assert sample("http_requests_total", status="404", **labels) == not_found + 2
+    assert sample("http_requests_in_flight", **labels) == 0
+
+
+def test_metrics_endpoint(client, mongo_mock, admin_headers):
+    client.get("/films")
+    response = client.get("/metrics", headers=admin_headers)
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    text = response.get_data(as_text=True)
+    assert 'http_requests_total{method="GET",route="/films",status="200"}' in text
+    assert "mongodb_command_duration_seconds" in text
+
+
+def test_command_listener_registered():
+    assert command_metrics in client_options()["event_listeners"]
+
+
+def test_command_metrics_by_collection():
+    listener = CommandMetrics()
+    labels = {"collection": "planets", "command": "find"}
+    before = sample("mongodb_command_duration_seconds_count", **labels)
+    total = sample("mongodb_command_duration_seconds_sum", **labels)
+
+    listener.started(command_event("find", {"find": "planets"}, 1))
+    listener.succeeded(command_event("find", {}, 1, reply={}))
+
+    assert sample("mongodb_command_duration_seconds_count", **labels) == before + 1
+    assert sample("mongodb_command_duration_seconds_sum", **labels) == total + 0.0025
+
+
+def test_command_metrics_get_more_and_failures():
+    listener = CommandMetrics()
+    labels = {"collection": "films", "command": "getMore"}
+    failures = sample("mongodb_command_failures_total", **labels)
+
+    listener.started(
+        command_event("getMore", {"getMore": 123, "collection": "films"}, 2)
+    )
+    listener.failed(command_event("getMore", {}, 2, failure={}))
+
+    assert sample("mongodb_command_failures_total", **labels) == failures + 1
+    assert listener._collections == {}
+
+
+def test_multiprocess_metrics_aggregated(tmp_path):
+    # Each process stands in for a uWSGI worker sharing the directory
+    env = {"PROMETHEUS_MULTIPROC_DIR": str(tmp_path), "PYTHONPATH": str(APP_DIR)}
+    worker = (
+        "from metrics import REQUESTS; "
+        "REQUESTS.labels('GET', '/films', '200').inc(3)"
+    )
+    for _ in range(2):
+        subprocess.run([sys.executable, "-c", worker], env=env, check=True)
+
+    reader = "import sys; from metrics import render; sys.stdout.buffer.write(render())"
+    output = subprocess.run(
+        [sys.executable, "-c", reader], env=env, check=True, capture_output=True
+    ).stdout.decode()
+    assert 'http_requests_total{method="GET",route="/films",status="200"} 6.0' in output
@@ -0,0 +1,74 @@
+import itertools
+import pstats
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def profiler(tmp_path, monkeypatch):
+    monkeypatch.setattr(server.request_profiler, "token", "secret")
+    monkeypatch.setattr(server.request_profiler, "profile_dir", str(tmp_path))
+    monkeypatch.setattr(server.request_profiler, "_sampled", {})
+    monkeypatch.setattr(server.request_profiler, "_requests", itertools.count(1))
+    return server.request_profiler
+
+
+def test_not_profiled_without_token(client, mongo_mock, profiler, tmp_path):
+    response = client.get("/films", headers={"X-Profile": "wrong"})
+    assert response.status_code == 200
+    assert "X-Profile-File" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+    response = client.get("/films?profile=secret")
+    assert "X-Profile-File" not in response.headers
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_profile_written_to_directory(client, mongo_mock, profiler, tmp_path):
+    response = client.get("/films", headers={"X-Profile": "secret"})
+    assert response.status_code == 200
+    assert response.get_json()["films"] == []
+
+    filename = response.headers["X-Profile-File"]
+    assert filename.startswith("GET_films.")
+    stats = pstats.Stats(str(tmp_path / filename))
+    assert any(func[2] == "list_films" for func in stats.stats)
+
+
+def test_profile_inline(client, mongo_mock, profiler):
+    response = client.get(
+        "/films/0123456789abcdef01234567?profile_output=inline",
+        headers={"X-Profile": "secret"},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert response.headers["X-Profile-Status"] == "404 NOT FOUND"
+    assert "get_film" in response.get_data(as_text=True)
+
+
+def test_sampled_profiles_aggregated_by_route(
+    client, mongo_mock, profiler, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(profiler, "sample_every", 2)
+    for _ in range(4):
+        client.get("/planets")
+    client.get("/films")
+
+    (path,) = tmp_path.glob("sampled-GET_planets.*.prof")
+    stats = pstats.Stats(str(path))
+    calls = [stats.stats[func][1] for func in stats.stats if func[2] == "list_planets"]
+    assert calls == [2]
+
+
+def test_exports_not_sampled(client, mongo_mock, profiler, tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "sample_every", 1)
+    response = client.get("/planets/export")
+    assert response.status_code == 200
+    assert list(tmp_path.iterdir()) == []
+
+    client.get("/planets")
+    assert [path.name.split(".")[0] for path in tmp_path.iterdir()] == [
+        "sampled-GET_planets"
+    ]
@@ -0,0 +1,25 @@
+from search import normalize, prefix_filter, search_keys, search_query
+
+
+def test_normalize():
+    assert normalize("Padmé  Amidala") == "padme amidala"
+    assert normalize("Star Wars: Episode I – The Phantom Menace") == (
+        "star wars episode i the phantom menace"
+    )
+
+
+def test_search_keys():
+    assert search_keys("A New Hope") == ["a new hope", "hope", "new hope"]
+    assert search_keys(["Ric Olié", "R5-D4"]) == ["d4", "olie", "r5 d4", "ric olie"]
+    assert search_keys(None) == []
+
+
+def test_prefix_filter_is_anchored_and_escaped():
+    assert prefix_filter("Luke Skywalker") == {"$regex": "^luke\\ skywalker"}
+    assert prefix_filter("(a+)+$") == {"$regex": "^a"}
+
+
+def test_search_query_skips_empty_terms():
+    assert search_query({"title": "Hope", "director": None}) == {
+        "_search.title": {"$regex": "^hope"}
+    }
@@ -1,7 +1,9 @@
 from datetime import datetime
 from server import app as flask_app
 from db import MongoDBConnection
+from service import FilmService, PlanetService
 import freezegun
+import mongomock
 
 
 def test_home(client):
@@ -112,6 +114,7 @@ def test_list_films_filters(client, mongo_mock):
         "planets": ["Naboo"],
     }
     MongoDBConnection.films().insert_many([film_data_one, film_data_two])
+    FilmService.backfill_search()
     response = client.get("/films?title=New&director=George&order_by=episode_id")
     assert response.status_code == 200
     data = response.get_json()
@@ -137,6 +140,7 @@ def test_list_films_filters_order_by(client, mongo_mock):
         "planets": ["Naboo"],
     }
     MongoDBConnection.films().insert_many([film_data_one, film_data_two])
+    FilmService.backfill_search()
     response = client.get("/films?director=George&order_by=-episode_id")
     assert response.status_code == 200
     data = response.get_json()
@@ -196,6 +200,7 @@ def test_list_films_filters_planet(client, mongo_mock):
         "planets": ["Naboo", "Tatooine"],
     }
     MongoDBConnection.films().insert_many([film_data_one, film_data_two])
+    FilmService.backfill_search()
     response = client.get("/films?planet=Tatooine")
     assert response.status_code == 200
     data = response.get_json()
@@ -266,3 +271,313 @@ def test_update_film_date(client, mongo_mock):
 
     assert data["films"][0]["title"] == "A New Hope"
     assert data["films"][0]["director"] == "Lucas Jorge"
+
+
+def test_list_films_cursor(client, mongo_mock):
+    MongoDBConnection.films().insert_many(
+        [
+            {
+                "title": f"Episode {episode_id}",
+                "episode_id": episode_id,
+                "director": "George Lucas",
+                "producer": ["Rick McCallum"],
+                "release_date": "1999-05-19",
+                "planets": ["Naboo"],
+            }
+            for episode_id in (3, 1, 2)
+        ]
+    )
+    response = client.get("/films?page_size=2&order_by=episode_id")
+    data = response.get_json()
+    assert [film["episode_id"] for film in data["films"]] == [1, 2]
+    assert data["next_cursor"]
+
+    response = client.get(
+        f"/films?page_size=2&order_by=episode_id&cursor={data['next_cursor']}"
+    )
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [film["episode_id"] for film in data["films"]] == [3]
+    assert data["next_cursor"] is None
+
+
+def test_list_films_cursor_invalid(client, mongo_mock):
+    response = client.get("/films?cursor=not-a-cursor")
+    assert response.status_code == 400
+
+
+def test_list_films_order_by_not_allowed(client, mongo_mock):
+    response = client.get("/films?order_by=producer")
+    assert response.status_code == 422
+
+
+def test_ensure_indexes_command(app, mongo_mock):
+    result = app.test_cli_runner().invoke(args=["ensure-indexes"])
+    assert result.exit_code == 0
+    assert "episode_id_1__id_1" in result.output
+
+
+def test_list_films_etag(client, mongo_mock):
+    response = client.get("/films?page_size=5")
+    etag = response.headers["ETag"]
+    assert response.status_code == 200
+
+    response = client.get("/films?page_size=5", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.headers["ETag"] == etag
+
+    response = client.get("/films?page_size=6", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+
+    FilmService.create(
+        {
+            "title": "A New Hope",
+            "episode_id": 4,
+            "director": "George Lucas",
+            "producer": ["Gary Kurtz"],
+            "release_date": "1977-05-25",
+            "planets": ["Tatooine"],
+        }
+    )
+    response = client.get("/films?page_size=5", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.get_json()["films"]) == 1
+
+
+def test_bulk_films(client, mongo_mock):
+    films = [
+        {
+            "title": "A New Hope",
+            "episode_id": 4,
+            "director": "George Lucas",
+            "producer": ["Gary Kurtz"],
+            "release_date": "1977-05-25",
+            "planets": ["Tatooine"],
+        },
+        {"title": "Missing fields"},
+        {
+            "title": "The Empire Strikes Back",
+            "episode_id": 5,
+            "director": "Irvin Kershner",
+            "producer": ["Gary Kurtz"],
+            "release_date": "1980-05-17",
+            "planets": ["Hoth"],
+        },
+    ]
+    response = client.post("/films/bulk", json=films)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["inserted"] == 2
+    assert [error["index"] for error in data["errors"]] == [1]
+    assert len(client.get("/films?planet=hoth").get_json()["films"]) == 1
+
+
+def test_bulk_films_upsert(client, mongo_mock):
+    film = {
+        "title": "A Old Hope",
+        "episode_id": 4,
+        "director": "George Lucas",
+        "producer": ["Gary Kurtz"],
+        "release_date": "1977-05-25",
+        "planets": ["Tatooine"],
+        "created": "1999-01-01 12:00:00",
+    }
+    client.post("/films/bulk?upsert=true", json=[film])
+    film["title"] = "A New Hope"
+    film["created"] = "2023-01-01 12:00:00"
+    response = client.post("/films/bulk?upsert=true", json=[film])
+    data = response.get_json()
+    assert data["upserted"] == 0
+    assert data["modified"] == 1
+
+    films = client.get("/films").get_json()["films"]
+    assert len(films) == 1
+    assert films[0]["title"] == "A New Hope"
+    assert films[0]["created"] == "1999-01-01 12:00:00"
+
+
+def test_bulk_films_not_an_array(client, mongo_mock):
+    response = client.post("/films/bulk", json={"title": "A New Hope"})
+    assert response.status_code == 400
+
+
+def test_list_films_totals(client, mongo_mock):
+    for episode_id in (1, 2, 3):
+        client.post(
+            "/films",
+            json={
+                "title": f"Episode {episode_id}",
+                "episode_id": episode_id,
+                "director": "George Lucas",
+                "producer": ["Rick McCallum"],
+                "release_date": "1999-05-19",
+                "planets": ["Naboo"],
+            },
+        )
+    data = client.get("/films?page_size=2").get_json()
+    assert data["total"] == 3
+    assert data["page_count"] == 2
+    assert data["has_next"] is True
+
+    data = client.get("/films?page_size=2&page=2&director=lucas").get_json()
+    assert data["total"] == 3
+    assert data["has_next"] is False
+    assert data["next_cursor"] is None
+
+    data = client.get("/films?page_size=2&include_total=false").get_json()
+    assert data["total"] is None
+    assert data["page_count"] is None
+    assert data["has_next"] is True
+
+
+def count_commands(monkeypatch) -> list:
+    commands = []
+    for name in ("find", "aggregate", "estimated_document_count"):
+        method = getattr(mongomock.collection.Collection, name)
+
+        def counted(self, *args, _name=name, _method=method, **kwargs):
+            commands.append(_name)
+            return _method(self, *args, **kwargs)
+
+        monkeypatch.setattr(mongomock.collection.Collection, name, counted)
+    return commands
+
+
+def test_list_films_expand_planets(client, mongo_mock, monkeypatch):
+    for name in ("Tatooine", "Alderaan", "Naboo", "Hoth"):
+        MongoDBConnection.planets().insert_one(
+            {"name": name, "climate": "arid", "films": []}
+        )
+    MongoDBConnection.films().insert_many(
+        [
+            {
+                "title": f"Episode {episode_id}",
+                "episode_id": episode_id,
+                "director": "George Lucas",
+                "producer": ["Rick McCallum"],
+                "release_date": "1999-05-19",
+                "planets": planets,
+            }
+            for episode_id, planets in (
+                (1, ["Naboo", "Tatooine"]),
+                (2, ["Naboo"]),
+                (4, ["Tatooine", "Alderaan", "Yavin IV"]),
+                (5, ["Hoth"]),
+            )
+        ]
+    )
+    commands = count_commands(monkeypatch)
+
+    response = client.get("/films?expand=planets&page_size=1&include_total=false")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [planet["name"] for planet in data["planets"]] == ["Naboo", "Tatooine"]
+    one_film = len(commands)
+
+    commands.clear()
+    data = client.get(
+        "/films?expand=planets&page_size=4&include_total=false"
+    ).get_json()
+    assert [planet["name"] for planet in data["planets"]] == [
+        "Alderaan",
+        "Hoth",
+        "Naboo",
+        "Tatooine",
+    ]
+    assert len(commands) == one_film
+
+    data = client.get("/films?expand=planets&fields=title").get_json()
+    assert set(data["films"][0]) == {"_id", "episode_id", "title", "planets"}
+    assert client.get("/films?expand=planets&exclude=planets").status_code == 422
+
+
+def test_list_films_expand_invalidated_by_planet_write(client, mongo_mock):
+    MongoDBConnection.films().insert_one(
+        {
+            "title": "A New Hope",
+            "episode_id": 4,
+            "director": "George Lucas",
+            "producer": ["Gary Kurtz"],
+            "release_date": "1977-05-25",
+            "planets": ["Tatooine"],
+        }
+    )
+    assert client.get("/films?expand=planets").get_json()["planets"] == []
+
+    PlanetService.create({"name": "Tatooine", "films": ["A New Hope"]})
+    data = client.get("/films?expand=planets").get_json()
+    assert [planet["name"] for planet in data["planets"]] == ["Tatooine"]
+
+
+def test_get_film(client, mongo_mock):
+    film_data = {
+        "title": "A New Hope",
+        "episode_id": 4,
+        "director": "George Lucas",
+        "producer": ["Gary Kurtz"],
+        "release_date": "1977-05-25",
+        "planets": ["Tatooine"],
+    }
+    film_id = FilmService.create(film_data)
+    response = client.get(f"/films/{film_id}")
+    assert response.status_code == 200
+    assert response.get_json()["title"] == "A New Hope"
+    assert "_search" not in response.get_json()
+
+    assert client.get(f"/films/{'5' * 24}").status_code == 404
+    assert client.get("/films/not-an-id").status_code == 400
+    assert client.put("/films/not-an-id", json=film_data).status_code == 400
+    assert client.delete("/films/not-an-id").status_code == 400
+
+
+def test_get_film_cache_dropped_on_update(client, mongo_mock):
+    film_data = {
+        "title": "A New Hope",
+        "episode_id": 4,
+        "director": "George Lucas",
+        "producer": ["Gary Kurtz"],
+        "release_date": "1977-05-25",
+        "planets": ["Tatooine"],
+    }
+    film_id = FilmService.create(film_data)
+    assert client.get(f"/films/{film_id}").get_json()["director"] == "George Lucas"
+    assert client.get(f"/films/{film_id}").get_json()["director"] == "George Lucas"
+
+    FilmService.update(str(film_id), {**film_data, "director": "Lucas Jorge"})
+    assert client.get(f"/films/{film_id}").get_json()["director"] == "Lucas Jorge"
+
+    # Ids are case-insensitive hex; a write through any spelling drops the
+    # cached document for every other client.
+    response = client.put(f"/films/{str(film_id).upper()}", json=film_data)
+    assert response.status_code == 200
+    client.delete_cookie("read_primary_until")
+    assert client.get(f"/films/{film_id}").get_json()["director"] == "George Lucas"
+
+    FilmService.delete(str(film_id))
+    assert client.get(f"/films/{film_id}").status_code == 404
+
+
+def test_list_films_by_ids(client, mongo_mock):
+    ids = [
+        FilmService.create(
+            {
+                "title": f"Episode {n}",
+                "episode_id": n,
+                "director": "George Lucas",
+                "producer": ["Rick McCallum"],
+                "release_date": "1999-05-19",
+                "planets": [],
+            }
+        )
+        for n in (1, 2, 3)
+    ]
+    response = client.get(f"/films?ids={ids[2]},{ids[0]},{'5' * 24}")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [film["episode_id"] for film in data["films"]] == [3, 1]
+    assert data["total"] == 2
+
+    assert client.get(f"/films?ids={ids[0]},nope").status_code == 400
+    assert client.get(f"/films?ids={ids[0]}&fields=title").status_code == 422
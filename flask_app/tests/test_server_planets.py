@@ -1,7 +1,12 @@
+import base64
+import json
 from datetime import datetime
 import freezegun
+import pytest
 from server import app as flask_app
-from db import MongoDBConnection
+from db import MongoDBConnection, sort_index
+from pymongo.errors import OperationFailure
+from service import PlanetService
 
 
 def test_create_planet(client, mongo_mock):
@@ -223,6 +228,7 @@ def test_list_planets_filters_planet_name(client, mongo_mock):
         ],
     }
     MongoDBConnection.planets().insert_many([planet_one, planet_two])
+    PlanetService.backfill_search()
     response = client.get("/planets?name=naboo")
     assert response.status_code == 200
     data = response.get_json()
@@ -290,6 +296,7 @@ def test_list_planets_filters_planet_name_residents(client, mongo_mock):
         ],
     }
     MongoDBConnection.planets().insert_many([planet_one, planet_two])
+    PlanetService.backfill_search()
     response = client.get("/planets?resident=luke%20skywalker")
     assert response.status_code == 200
     data = response.get_json()
@@ -426,6 +433,7 @@ def test_list_planets_filters_films(client, mongo_mock):
         ],
     }
     MongoDBConnection.planets().insert_many([planet_one, planet_two])
+    PlanetService.backfill_search()
     response = client.get("/planets?film=The%20Phantom%20Menace")
     assert response.status_code == 200
     data = response.get_json()
@@ -541,3 +549,244 @@ def test_update_planet_date(client, mongo_mock):
 
     assert data["planets"][0]["name"] == "Naboo"
     assert data["planets"][0]["climate"] == "temperate"
+
+
+def test_bulk_planets_ndjson(client, mongo_mock):
+    body = b"\n".join(
+        [
+            json.dumps({"name": "Hoth", "films": ["The Empire Strikes Back"]}).encode(),
+            b"{not json",
+            b"",
+            json.dumps({"name": "Dagobah", "films": []}).encode(),
+        ]
+    )
+    response = client.post(
+        "/planets/bulk", data=body, content_type="application/x-ndjson"
+    )
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["inserted"] == 2
+    assert [error["index"] for error in data["errors"]] == [1]
+    assert len(client.get("/planets").get_json()["planets"]) == 2
+
+
+def test_export_planets(client, mongo_mock):
+    PlanetService.create({"name": "Hoth", "films": ["The Empire Strikes Back"]})
+    PlanetService.create({"name": "Naboo", "films": ["The Phantom Menace"]})
+
+    response = client.get("/planets/export?film=empire")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    lines = response.data.decode().splitlines()
+    assert [json.loads(line)["name"] for line in lines] == ["Hoth"]
+    assert "_search" not in lines[0]
+
+    response = client.get("/planets/export?format=csv&order_by=-name")
+    assert response.mimetype == "text/csv"
+    rows = response.data.decode().splitlines()
+    assert rows[0].startswith("_id,name,")
+    assert [row.split(",")[1] for row in rows[1:]] == ["Naboo", "Hoth"]
+
+
+def test_export_planets_hints(client, mongo_mock, monkeypatch):
+    PlanetService.create({"name": "Hoth", "films": ["The Empire Strikes Back"]})
+    hints = []
+    disk = []
+    monkeypatch.setattr(
+        "mongomock.collection.Cursor.hint",
+        lambda self, index: hints.append(index) or self,
+    )
+    monkeypatch.setattr(
+        "mongomock.collection.Cursor.allow_disk_use",
+        lambda self, allow: disk.append(allow) or self,
+    )
+
+    assert client.get("/planets/export?order_by=-name").status_code == 200
+    assert disk[-1] is False
+    assert client.get("/planets/export?film=empire").status_code == 200
+    assert disk[-1] is True
+    assert hints == [sort_index("name"), [("_search.films", 1)]]
+
+
+def failing_export(*docs):
+    def export(*args, **kwargs):
+        yield from docs
+        raise OperationFailure("cursor killed")
+
+    return export
+
+
+def test_export_planets_fails_before_first_chunk(client, mongo_mock, monkeypatch):
+    monkeypatch.setattr(PlanetService, "export", failing_export())
+
+    response = client.get("/planets/export")
+    assert response.status_code == 500
+    assert response.get_json() == {"error": "cursor killed"}
+
+
+def test_export_planets_fails_mid_stream(client, mongo_mock, monkeypatch):
+    monkeypatch.setattr("export.EXPORT_CHUNK_BYTES", 1)
+    monkeypatch.setattr(PlanetService, "export", failing_export({"name": "Hoth"}))
+
+    response = client.get("/planets/export", buffered=False)
+    assert response.status_code == 200
+    chunks = []
+    with pytest.raises(OperationFailure):
+        for chunk in response.response:
+            chunks.append(chunk)
+    lines = b"".join(chunks).decode().splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {"name": "Hoth"},
+        {"error": "cursor killed"},
+    ]
+
+    response = client.get("/planets/export?format=csv", buffered=False)
+    with pytest.raises(OperationFailure):
+        list(response.response)
+
+
+def test_list_planets_fields(client, mongo_mock):
+    PlanetService.create(
+        {
+            "name": "Hoth",
+            "climate": "frozen",
+            "residents": [],
+            "films": ["The Empire Strikes Back"],
+        }
+    )
+
+    response = client.get("/planets?fields=name,climate")
+    assert response.status_code == 200
+    planet = response.get_json()["planets"][0]
+    assert set(planet) == {"_id", "name", "climate"}
+
+    response = client.get("/planets?exclude=residents&exclude=films")
+    assert response.status_code == 200
+    planet = response.get_json()["planets"][0]
+    assert "residents" not in planet
+    assert "films" not in planet
+    assert planet["climate"] == "frozen"
+
+
+def test_list_planets_fields_sort_key_kept(client, mongo_mock):
+    PlanetService.create({"name": "Hoth", "climate": "frozen", "films": []})
+    PlanetService.create({"name": "Naboo", "climate": "temperate", "films": []})
+
+    response = client.get("/planets?fields=climate&order_by=name&page_size=1")
+    data = response.get_json()
+    assert set(data["planets"][0]) == {"_id", "name", "climate"}
+
+    response = client.get(
+        f"/planets?fields=climate&order_by=name&page_size=1&cursor={data['next_cursor']}"
+    )
+    assert response.get_json()["planets"][0]["climate"] == "temperate"
+
+
+def test_list_planets_fields_invalid(client, mongo_mock):
+    assert client.get("/planets?fields=name,password").status_code == 422
+    assert client.get("/planets?fields=name&exclude=films").status_code == 422
+
+
+def test_list_planets_expand_films(client, mongo_mock):
+    MongoDBConnection.films().insert_many(
+        [
+            {
+                "title": "A New Hope",
+                "episode_id": 4,
+                "director": "George Lucas",
+                "producer": ["Gary Kurtz"],
+                "release_date": "1977-05-25",
+                "planets": ["Tatooine"],
+            },
+            {
+                "title": "Return of the Jedi",
+                "episode_id": 6,
+                "director": "Richard Marquand",
+                "producer": ["Howard Kazanjian"],
+                "release_date": "1983-05-25",
+                "planets": [],
+            },
+        ]
+    )
+    MongoDBConnection.planets().insert_many(
+        [
+            {"name": "Tatooine", "films": ["Return of the Jedi", "A New Hope"]},
+            {"name": "Hoth", "films": ["The Empire Strikes Back"]},
+        ]
+    )
+    response = client.get("/planets?expand=films")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert [film["episode_id"] for film in data["films"]] == [4, 6]
+    assert "_search" not in data["films"][0]
+    assert "films" not in client.get("/planets").get_json()
+
+
+def test_get_planets_by_id(client, mongo_mock):
+    tatooine = PlanetService.create({"name": "Tatooine", "films": ["A New Hope"]})
+    hoth = PlanetService.create({"name": "Hoth", "films": []})
+
+    response = client.get(f"/planets/{tatooine}")
+    assert response.status_code == 200
+    assert response.get_json()["name"] == "Tatooine"
+    assert client.get("/planets/123").status_code == 400
+
+    data = client.get(f"/planets?ids={hoth},{tatooine}").get_json()
+    assert [planet["name"] for planet in data["planets"]] == ["Hoth", "Tatooine"]
+
+
+@pytest.mark.parametrize("query", ["page_size=0", "page_size=-1", "page=0", "page=-2"])
+def test_list_planets_page_out_of_range(client, mongo_mock, query):
+    response = client.get(f"/planets?{query}")
+    assert response.status_code == 422
+
+
+def test_list_planets_large_page_size(client, mongo_mock):
+    for n in range(3):
+        PlanetService.create({"name": f"P{n}", "films": []})
+    response = client.get("/planets?page_size=1000")
+    assert response.status_code == 200
+    assert len(response.get_json()["planets"]) == 3
+
+
+@pytest.mark.parametrize(
+    "raw",
+    [
+        '["name", "x", {"$oid": "zz"}]',
+        '["name", {"$date": "x"}, 1]',
+        '{"a": 1, "b": 2, "c": 3}',
+        '["name", "x"]',
+        "not json",
+    ],
+)
+def test_list_planets_crafted_cursor(client, mongo_mock, raw):
+    cursor = base64.urlsafe_b64encode(raw.encode()).decode()
+    response = client.get(f"/planets?cursor={cursor}")
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Invalid cursor"}
+
+
+@pytest.mark.parametrize("order_by", ["rotation_period", "-rotation_period"])
+def test_list_planets_cursor_over_missing_values(client, mongo_mock, order_by):
+    MongoDBConnection.planets().insert_many(
+        [
+            {"name": "P0", "films": []},
+            {"name": "P1", "rotation_period": None, "films": []},
+            {"name": "P2", "rotation_period": "23", "films": []},
+            {"name": "P3", "films": []},
+            {"name": "P4", "rotation_period": "10", "films": []},
+        ]
+    )
+    names = []
+    url = f"/planets?order_by={order_by}&page_size=2&include_total=false"
+    cursor = None
+    while True:
+        data = client.get(url + (f"&cursor={cursor}" if cursor else "")).get_json()
+        names += [planet["name"] for planet in data["planets"]]
+        cursor = data["next_cursor"]
+        if cursor is None:
+            break
+    assert sorted(names) == ["P0", "P1", "P2", "P3", "P4"]
+    assert len(names) == 5
+    nulls = names[:3] if order_by == "rotation_period" else names[2:]
+    assert sorted(nulls) == ["P0", "P1", "P3"]
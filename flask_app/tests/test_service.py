@@ -1,8 +1,8 @@
 import pytest
 from bson import ObjectId
 
-from service import FilmService
-from db import MongoDBConnection
+from service import FilmService, encode_cursor, next_cursor
+from db import MongoDBConnection, sort_index
 
 
 def test_mongodb_connection_setup(mongo_mock):
@@ -77,6 +77,7 @@ def test_list_films(mongo_mock):
     film_data_1 = {"title": "Film One", "episode_id": 1, "director": "Director One"}
     film_data_2 = {"title": "Film Two", "episode_id": 2, "director": "Director Two"}
     MongoDBConnection.films().insert_many([film_data_1, film_data_2])
+    FilmService.backfill_search()
 
     films = FilmService.list()
     assert len(films) == 2
@@ -98,3 +99,137 @@ def test_list_films_order_by(mongo_mock):
     filtered_films = FilmService.list(**{"order_by": "-episode_id"})
     assert len(filtered_films) == 2
     assert filtered_films[0]["title"] == "Film Two"
+
+
+def test_list_films_cursor_descending(mongo_mock):
+    MongoDBConnection.films().insert_many(
+        [{"title": f"Film {i}", "episode_id": i % 2} for i in range(5)]
+    )
+
+    seen = []
+    cursor = None
+    while True:
+        films = FilmService.list(order_by="-episode_id", page_size=2, cursor=cursor)
+        seen.extend(films)
+        cursor = next_cursor(films, "-episode_id", 2)
+        if cursor is None:
+            break
+
+    assert len(seen) == 5
+    assert len({film["_id"] for film in seen}) == 5
+    assert [film["episode_id"] for film in seen] == [1, 1, 0, 0, 0]
+
+
+def test_list_films_cursor_order_by_mismatch(mongo_mock):
+    film_id = MongoDBConnection.films().insert_one({"episode_id": 1}).inserted_id
+    cursor = encode_cursor({"_id": film_id, "episode_id": 1}, "episode_id")
+    with pytest.raises(ValueError):
+        FilmService.list(order_by="-episode_id", cursor=cursor)
+
+
+def test_list_films_order_by_not_allowed(mongo_mock):
+    with pytest.raises(ValueError):
+        FilmService.list(order_by="producer")
+
+
+def test_ensure_indexes(mongo_mock):
+    MongoDBConnection.ensure_indexes()
+    MongoDBConnection.ensure_indexes()
+
+    films_indexes = MongoDBConnection.films().index_information()
+    assert list(films_indexes["episode_id_1__id_1"]["key"]) == [
+        ("episode_id", 1),
+        ("_id", 1),
+    ]
+    assert "_search.planets_1" in films_indexes
+
+    planets_indexes = MongoDBConnection.planets().index_information()
+    assert "rotation_period_1__id_1" in planets_indexes
+    assert "_search.residents_1" in planets_indexes
+
+
+def test_film_search_fields_maintained(mongo_mock):
+    film_id = FilmService.create(
+        {"title": "Old Title", "episode_id": 2, "planets": ["Alderaan"]}
+    )
+    FilmService.update(str(film_id), {"title": "L'Empire Contre-Attaque"})
+
+    film = MongoDBConnection.films().find_one({"_id": film_id})
+    assert "contre attaque" in film["_search"]["title"]
+    assert film["_search"]["planets"] == ["alderaan"]
+
+    films = FilmService.list(title="empire contre")
+    assert [f["_id"] for f in films] == [film_id]
+    assert "_search" not in films[0]
+    assert FilmService.list(title="old") == []
+
+
+def test_film_page_totals(mongo_mock):
+    for episode_id in range(1, 6):
+        FilmService.create(
+            {"title": f"Film {episode_id}", "episode_id": episode_id, "planets": []}
+        )
+
+    page = FilmService.page(page=2, page_size=2, include_total=True)
+    assert [f["episode_id"] for f in page["items"]] == [3, 4]
+    assert page["total"] == 5
+    assert page["has_next"] is True
+
+    page = FilmService.page(title="film", page=3, page_size=2, include_total=True)
+    assert [f["episode_id"] for f in page["items"]] == [5]
+    assert page["total"] == 5
+    assert page["has_next"] is False
+
+    assert FilmService.page(title="film 1", include_total=True)["total"] == 1
+    assert FilmService.page(title="film")["total"] is None
+
+
+def test_film_page_total_cached_until_write(mongo_mock, monkeypatch):
+    FilmService.create({"title": "A New Hope", "episode_id": 4, "planets": []})
+    assert FilmService.page(title="new", include_total=True)["total"] == 1
+
+    def no_count(*args, **kwargs):
+        raise AssertionError("count should come from the cache")
+
+    monkeypatch.setattr("mongomock.collection.Collection.count_documents", no_count)
+    assert FilmService.page(title="new", include_total=True)["total"] == 1
+
+    monkeypatch.undo()
+    FilmService.create({"title": "New Republic", "episode_id": 10, "planets": []})
+    assert FilmService.page(title="new", include_total=True)["total"] == 2
+
+
+def test_film_page_hints(mongo_mock, monkeypatch):
+    FilmService.create({"title": "A New Hope", "episode_id": 4, "planets": []})
+    hints = []
+    monkeypatch.setattr(
+        "mongomock.collection.Cursor.hint",
+        lambda self, index: hints.append(index) or self,
+    )
+
+    FilmService.page(order_by="-episode_id", include_total=True)
+    assert hints == [sort_index("episode_id")]
+
+    hints.clear()
+    page = FilmService.page(title="new", order_by="-episode_id", include_total=True)
+    assert page["total"] == 1
+    assert hints == [[("_search.title", 1)]]
+
+
+def test_bulk_save_reports_write_errors(mongo_mock, monkeypatch):
+    monkeypatch.setattr("service.BULK_CHUNK_SIZE", 2)
+    film_id = ObjectId()
+    rows = [
+        (0, {"_id": film_id, "title": "One"}),
+        (1, {"title": "Two"}),
+        (2, {"_id": film_id, "title": "Duplicate"}),
+    ]
+
+    result = FilmService.bulk_save(rows)
+
+    assert result["inserted"] == 2
+    assert [error["index"] for error in result["errors"]] == [2]
+
+
+def test_next_cursor_empty_page():
+    assert next_cursor([], "name", 10) is None
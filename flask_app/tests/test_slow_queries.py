@@ -0,0 +1,165 @@
+import json
+
+import pytest
+
+from db import MongoDBConnection, SlowQueryLog, plan_summary, query_fields, slow_queries
+from service import PlanetService
+
+FIND_EXPLAIN = {
+    "queryPlanner": {
+        "winningPlan": {
+            "stage": "SORT",
+            "inputStage": {
+                "stage": "FETCH",
+                "inputStage": {"stage": "IXSCAN", "indexName": "_search.residents_1"},
+            },
+        }
+    }
+}
+AGGREGATE_EXPLAIN = {
+    "stages": [
+        {"$cursor": {"queryPlanner": {"winningPlan": {"stage": "COLLSCAN"}}}},
+        {"$sort": {"sortKey": {"name": 1, "_id": 1}}},
+    ]
+}
+
+
+@pytest.fixture
+def record_all(monkeypatch):
+    monkeypatch.setattr(slow_queries, "threshold_ms", 0)
+    monkeypatch.setattr(slow_queries, "explain_rate", 0)
+
+
+def test_plan_summary():
+    assert plan_summary(FIND_EXPLAIN) == {
+        "stages": ["SORT", "FETCH", "IXSCAN"],
+        "indexes": ["_search.residents_1"],
+        "collscan": False,
+        "in_memory_sort": True,
+    }
+    plan = plan_summary(AGGREGATE_EXPLAIN)
+    assert plan["collscan"] is True
+    assert plan["in_memory_sort"] is True
+
+
+def test_query_fields():
+    keyset = {"$or": [{"name": {"$gt": "A"}}, {"name": "A", "_id": {"$gt": 1}}]}
+    query = {"_search.residents": {"$regex": "^luke"}, **keyset}
+    assert query_fields(query) == ["_id", "_search.residents", "name"]
+
+
+def test_fast_queries_not_recorded(mongo_mock):
+    log = SlowQueryLog(threshold_ms=60000, explain_rate=1)
+    with log.track(MongoDBConnection.planets(), "find", {"name": "Tatooine"}):
+        pass
+    assert log.report()["shapes"] == []
+
+
+def test_slow_query_explained(mongo_mock):
+    log = SlowQueryLog(threshold_ms=0, explain_rate=1)
+    planets = MongoDBConnection.planets()
+    for _ in range(2):
+        log.record(
+            planets,
+            "find",
+            {"_search.residents": {"$regex": "^luke"}},
+            [("name", 1), ("_id", 1)],
+            0,
+            21,
+            250.0,
+            lambda: FIND_EXPLAIN,
+        )
+
+    (shape,) = log.report()["shapes"]
+    assert shape["fields"] == ["_search.residents"]
+    assert shape["sort"] == "name:1,_id:1"
+    assert shape["count"] == 2
+    assert shape["avg_ms"] == 250.0
+    assert shape["explained"] == 2
+    assert shape["in_memory_sort"] == 2
+    assert shape["collscan"] == 0
+    assert shape["plan"]["indexes"] == ["_search.residents_1"]
+
+
+def test_failed_explain_still_recorded(mongo_mock):
+    def explain():
+        raise NotImplementedError("explain")
+
+    log = SlowQueryLog(threshold_ms=0, explain_rate=1)
+    log.record(MongoDBConnection.planets(), "find", {}, None, 0, 0, 150.0, explain)
+    (shape,) = log.report()["shapes"]
+    assert shape["explained"] == 0
+    assert shape["plan"] is None
+
+
+def test_planet_filters_grouped_by_shape(client, mongo_mock, record_all, admin_headers):
+    PlanetService.create({"name": "Tatooine", "residents": ["Luke Skywalker"]})
+    client.get("/planets?resident=Luke&include_total=false")
+    client.get("/planets?resident=Owen&include_total=false")
+    client.get("/planets?name=Tatooine&include_total=false")
+
+    response = client.get("/db/slow-queries", headers=admin_headers)
+    assert response.status_code == 200
+    shapes = {tuple(shape["fields"]): shape for shape in response.get_json()["shapes"]}
+    assert shapes[("_search.residents",)]["count"] == 2
+    assert shapes[("_search.residents",)]["sort"] == "name:1,_id:1"
+    assert shapes[("_search.name",)]["count"] == 1
+
+
+def test_slow_queries_command(app, mongo_mock, record_all):
+    app.test_client().get("/planets?resident=Luke&include_total=false")
+    result = app.test_cli_runner().invoke(args=["slow-queries"])
+    assert result.exit_code == 0
+    assert "planets find fields=_search.residents sort=name:1,_id:1" in result.output
+
+
+def test_explained_with_query_planner(client, mongo_mock, record_all, monkeypatch):
+    commands = []
+
+    def command(self, name, value, verbosity=None):
+        commands.append((value, verbosity))
+        return FIND_EXPLAIN
+
+    monkeypatch.setattr(slow_queries, "explain_rate", 1)
+    monkeypatch.setattr("mongomock.database.Database.command", command)
+    client.get("/planets?resident=Luke&include_total=true")
+
+    (find, find_verbosity), (count, count_verbosity) = sorted(
+        commands, key=lambda c: "count" in c[0]
+    )
+    assert find_verbosity == count_verbosity == "queryPlanner"
+    assert find["find"] == "planets"
+    assert find["sort"] == {"name": 1, "_id": 1}
+    assert find["hint"] == {"_search.residents": 1}
+    assert find["limit"] == 11
+    assert count["count"] == "planets"
+    assert count["hint"] == {"_search.residents": 1}
+
+
+def test_admin_endpoints_need_token(client, mongo_mock, monkeypatch):
+    paths = ["/db/slow-queries", "/db/pool", "/cache/stats", "/metrics"]
+    for path in paths:
+        assert client.get(path).status_code == 404
+
+    monkeypatch.setattr("admin.ADMIN_TOKEN", "secret")
+    for path in paths:
+        assert client.get(path).status_code == 401
+        response = client.get(path, headers={"Authorization": "Bearer wrong"})
+        assert response.status_code == 401
+        response = client.get(path, headers={"Authorization": "Bearer secret"})
+        assert response.status_code == 200
+
+
+def test_recorded_filter_redacted(mongo_mock):
+    log = SlowQueryLog(threshold_ms=0, explain_rate=0)
+    query = {
+        "_search.residents": {"$regex": "^luke"},
+        "$or": [{"name": {"$gt": "Hoth"}}, {"name": "Hoth", "_id": {"$gt": 1}}],
+    }
+    log.record(MongoDBConnection.planets(), "find", query, None, 0, 0, 150.0)
+
+    (shape,) = log.report()["shapes"]
+    assert json.loads(shape["example"]) == {
+        "_search.residents": {"$regex": "?"},
+        "$or": [{"name": {"$gt": "?"}}, {"name": "?", "_id": {"$gt": "?"}}],
+    }
@@ -0,0 +1,129 @@
+import io
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from flask import Response
+
+import timing
+from db import CommandMetrics
+from service import FilmService
+
+FILM = {
+    "title": "A New Hope",
+    "episode_id": 4,
+    "director": "George Lucas",
+    "producer": ["Gary Kurtz"],
+    "release_date": "1977-05-25",
+    "planets": ["Tatooine"],
+}
+
+
+@pytest.fixture
+def log_lines(monkeypatch):
+    lines = []
+    monkeypatch.setattr(timing.logger, "info", lines.append)
+    return lines
+
+
+def server_timing(response) -> dict:
+    entries = (
+        entry.split(";dur=") for entry in response.headers["Server-Timing"].split(", ")
+    )
+    return {name: float(duration) for name, duration in entries}
+
+
+def test_server_timing_header(client, mongo_mock, log_lines):
+    FilmService.create(FILM)
+    response = client.get("/films")
+    phases = server_timing(response)
+
+    assert list(phases) == [*timing.PHASES, "total"]
+    assert phases["validation"] > 0
+    assert phases["serialization"] > 0
+    assert phases["response_validation"] > 0
+    assert sum(phases[name] for name in timing.PHASES) <= phases["total"]
+
+
+def test_log_line_with_request_id(client, mongo_mock, log_lines):
+    response = client.get("/films/0123456789abcdef01234567")
+    (line,) = log_lines
+    entry = json.loads(line)
+
+    assert entry["request_id"] == response.headers["X-Request-ID"]
+    assert entry["route"] == "/films/<film_id>"
+    assert entry["status"] == 404
+    assert entry["total_ms"] > 0
+    assert set(entry) >= {f"{name}_ms" for name in timing.PHASES}
+
+
+def test_request_id_from_nginx(client, mongo_mock, log_lines):
+    response = client.get("/films", headers={"X-Request-ID": "abc123"})
+    assert response.headers["X-Request-ID"] == "abc123"
+
+    response = client.get("/films", headers={"X-Request-ID": '"><script>'})
+    assert len(response.headers["X-Request-ID"]) == 32
+
+
+def test_mongo_time_from_command_events():
+    listener = CommandMetrics()
+    event = SimpleNamespace(
+        command_name="find",
+        command={"find": "films"},
+        connection_id=("localhost", 27017),
+        request_id=1,
+        operation_id=1,
+        duration_micros=1500,
+    )
+    timings = timing.begin()
+    try:
+        for _ in range(2):
+            listener.started(event)
+            listener.succeeded(event)
+    finally:
+        timing.end()
+    assert timings.phases["mongo"] == pytest.approx(0.003)
+
+
+def test_disabled(client, mongo_mock, monkeypatch, log_lines):
+    monkeypatch.setattr(timing, "SERVER_TIMING", False)
+    response = client.get("/films")
+    assert "Server-Timing" not in response.headers
+    assert log_lines == []
+
+
+def best_of(fn, calls: int, rounds: int = 5) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+def test_overhead_small_next_to_a_request(client, mongo_mock, monkeypatch):
+    # Everything timing adds to one request, log line written included,
+    # against the cheapest real list request (in-memory Mongo, no cache).
+    monkeypatch.setattr(timing.logger.handlers[0], "stream", io.StringIO())
+    monkeypatch.setattr("cache.response_cache.get", lambda key: None)
+    FilmService.create(FILM)
+    response = Response()
+
+    def one_request():
+        timing.begin("bench")
+        timing.mark("dispatch")
+        timing.since("dispatch", "validation")
+        for _ in range(3):
+            timing.add("mongo", 0.001)
+        with timing.measure("serialization"):
+            pass
+        timing.mark("response")
+        timing.since("response", "response_validation")
+        timing.finish(response, "GET", "/films")
+        timing.end()
+
+    overhead = best_of(one_request, 2000)
+    request = best_of(lambda: client.get("/films?include_total=false"), 100)
+    assert overhead < request * 0.05
@@ -0,0 +1,52 @@
+import pytest
+
+from db import MongoDBConnection
+from validation import response_validator
+
+
+@pytest.fixture
+def validation_mode():
+    yield response_validator.configure
+    response_validator.configure("strict", 0.01)
+
+
+def test_strict_response_validation(client, mongo_mock, validation_mode):
+    MongoDBConnection.films().insert_one({"title": "Bad", "episode_id": "four"})
+    response = client.get("/films")
+    assert response.status_code == 500
+
+
+def test_response_validation_off(client, mongo_mock, validation_mode):
+    validation_mode("off")
+    MongoDBConnection.films().insert_one({"title": "Bad", "episode_id": "four"})
+    response = client.get("/films")
+    assert response.status_code == 200
+    assert client.get("/films?order_by=producer").status_code == 422
+
+
+def test_sampled_response_validation_logs(client, mongo_mock, validation_mode, caplog):
+    validation_mode("sampled", 1.0)
+    violations = response_validator.violations
+    MongoDBConnection.films().insert_one({"title": "Bad", "episode_id": "four"})
+
+    response = client.get("/films")
+
+    assert response.status_code == 200
+    assert response_validator.violations == violations + 1
+    assert "Response validation error on GET /films" in caplog.text
+
+
+def test_invalid_validation_mode():
+    with pytest.raises(ValueError):
+        response_validator.configure("sometimes")
+
+
+def test_partial_model_only_for_sparse_fieldsets(client, mongo_mock, validation_mode):
+    MongoDBConnection.films().insert_one({"title": "Incomplete", "episode_id": 4})
+    MongoDBConnection.planets().insert_one({"name": "Hoth"})
+
+    assert client.get("/films").status_code == 500
+    assert client.get("/planets").status_code == 500
+    assert client.get("/films?fields=title").status_code == 200
+    assert client.get("/films?exclude=producer").status_code == 200
+    assert client.get("/planets?fields=name").status_code == 200
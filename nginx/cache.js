@@ -0,0 +1,51 @@
+import crypto from "crypto";
+
+// Collection versions shared by all nginx workers. The API bumps a version
+// after each write, which moves every cached response of that collection
+// to a new key; the old entries are never read again and age out.
+const COLLECTIONS = ["films", "planets"];
+
+// The versions start over at 0 whenever nginx starts, but the disk cache
+// keeps the entries written under the old ones. A random epoch picked at the
+// first request after start goes into every key, so those are never reused.
+// add() never overwrites, so every worker reads the same epoch.
+function epoch(versions) {
+    if (!versions.has("epoch")) {
+        versions.add("epoch", Math.floor(Math.random() * 0x7fffffff) + 1);
+    }
+    return versions.get("epoch");
+}
+
+function version(r) {
+    const versions = ngx.shared.cache_versions;
+    return [epoch(versions)]
+        .concat(COLLECTIONS.map((name) => versions.get(name) || 0))
+        .join(".");
+}
+
+function bump(r) {
+    const collection = r.args.collection;
+    if (!COLLECTIONS.includes(collection)) {
+        r.return(400);
+        return;
+    }
+    ngx.shared.cache_versions.incr(collection, 1, 0);
+    r.return(204);
+}
+
+// Only a request carrying the app's PROFILE_TOKEN skips the micro-cache; any
+// other X-Profile is served like a plain request, so it can't be used to get
+// around proxy_cache_lock. Both sides are hashed before comparing, so the
+// comparison time says nothing about the token.
+function profiled(r) {
+    const token = process.env.PROFILE_TOKEN;
+    const sent = r.headersIn["X-Profile"];
+    if (!token || !sent) {
+        return "";
+    }
+    const digest = (value) =>
+        crypto.createHmac("sha256", token).update(value).digest("hex");
+    return digest(sent) === digest(token) ? "1" : "";
+}
+
+export default { version, bump, profiled };